@@ -1,19 +1,52 @@
 import json 
 
 from db import db
+from db import upgrade_schema
+from db import database_path
 from db import Event
 from db import User 
 from db import Bucket
 from db import Asset
 from db import Category
+from db import ReminderSent
+from db import TrendingEvent
+from db import CacheInvalidation, CACHE_INVALIDATION_RETENTION
+from db import ASSET_FAILED, ASSET_PENDING
+from db import decode_image
+from db import USER_FIELDS, USER_LISTS
+from db import category_association_table
+from db import created_events_association_table
+from db import saved_buckets_association_table
+from db import saved_events_association_table
+from db import user_bucket_list_association_table
+from db import add_association, has_association, remove_association
 
+import compression
+import google_login
+import metrics
+import recommend
+import trending
 import users_dao
+from cache import ResponseCache, event_tags
+from images import LimitedUpload, UploadTooLarge, hash_upload, process_in_background, spool_upload
+from pagination import PaginationError, decode_cursor, encode_cursor, paginate_by_date, parse_limit
+from search import create_search_index, search_event_ids, search_filter
+from streaming import iter_by_date, stream_json
 
 import datetime
-import random
+import hashlib
+from io import BytesIO
+from mimetypes import guess_type
+import threading
+import time
 
 from flask import Flask
+from flask import g
 from flask import request 
+from flask import stream_with_context
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.http import http_date
+from dateutil import tz
 
 import requests
 
@@ -22,29 +55,53 @@ import os
 # Third-party libraries
 from flask import Flask, redirect, request, url_for
 
-# google libraries
-from google.oauth2 import id_token
-from google.auth.transport import requests
-import requests
-
 # define db filename 
 app = Flask(__name__)
 app.secret_key = os.environ.get("SECRET_KEY") or os.urandom(24)
-db_filename = "bukethaca.db"
+db_filename = database_path()
 
 # setup config 
 app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///%s" % db_filename
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["SQLALCHEMY_ECHO"] = True
+app.config["SQLALCHEMY_ECHO"] = metrics.echo_enabled()
 GOOGLE_CLIENT_ID = os.environ.get("GOOGLE_CLIENT_ID", None)
 GOOGLE_DISCOVERY_URL = (
     "https://accounts.google.com/.well-known/openid-configuration"
 )
+MAX_RANDOM_EVENTS = 20
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", 10 * 1024 * 1024))
+# Werkzeug rejects form bodies declaring more than this before parsing them
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_BYTES
+# user fields returned by mutation endpoints unless ?fields= asks for more
+MUTATION_FIELDS = ("id",)
+# user fields returned with the session tokens on login
+LOGIN_FIELDS = ("id", "name", "email", "number")
+# most ids per operation in one batch request; saved event rows take three
+# bound parameters (user, event, saved_at), so a multi-row insert binds at
+# most 750, under SQLite's default limit of 999
+MAX_BATCH_IDS = 250
+# time-dependent listings (relative to now) are cached at most this long
+TIME_WINDOW_TTL = int(os.environ.get("TIME_WINDOW_TTL", 60))
+UPCOMING_WINDOW = 7 * 24 * 60 * 60
+MAX_UPCOMING_WINDOW = 365 * 24 * 60 * 60
+MAX_QUERY_CATEGORIES = 50
+LOCAL_TIMEZONE = tz.gettz(os.environ.get("LOCAL_TIMEZONE", "America/New_York"))
+response_cache = ResponseCache(int(os.environ.get("RESPONSE_CACHE_SIZE", 512)))
+# seconds between checks for cache tags invalidated by other processes
+CACHE_SYNC_INTERVAL = float(os.environ.get("CACHE_SYNC_INTERVAL", 1))
+# the newest cache_invalidations row seen and when it was last checked
+cache_sync = {"last_id": 0, "checked": time.monotonic()}
+cache_sync_lock = threading.Lock()
 
 # initialize app
 db.init_app(app)
+metrics.init_app(app)
+compression.init_app(app)
 with app.app_context():
     db.create_all()
+    upgrade_schema()
+    create_search_index()
+    cache_sync["last_id"] = CacheInvalidation.latest_id()
 
 # generalized response formats 
 def success_response(data, code=200):
@@ -59,38 +116,282 @@ def failure_response(message, code=404):
     """
     return json.dumps({"error": message}), code
 
+# cached response helpers
+@app.before_request
+def sync_response_cache():
+    """
+    Drops cached responses whose tags other processes (notify.py) have
+    invalidated since the last check, at most every CACHE_SYNC_INTERVAL
+    seconds; one primary key range read, usually empty
+    """
+    now = time.monotonic()
+    if now - cache_sync["checked"] < CACHE_SYNC_INTERVAL or not cache_sync_lock.acquire(blocking=False):
+        return
+    try:
+        if now - cache_sync["checked"] >= CACHE_INVALIDATION_RETENTION:
+            # rows we have not seen may already be pruned
+            cache_sync["last_id"] = CacheInvalidation.latest_id()
+            response_cache.clear()
+        else:
+            cache_sync["last_id"], tags = CacheInvalidation.since(cache_sync["last_id"])
+            if tags:
+                response_cache.invalidate(*tags)
+        cache_sync["checked"] = now
+    finally:
+        cache_sync_lock.release()
+
+def cache_key():
+    """
+    Cache key for the current request: its route and query parameters
+    """
+    return (request.path, tuple(sorted(request.args.items(multi=True))))
+
+def cached_success_response(entry):
+    """
+    Success response for a cache entry, answering conditional requests
+    with 304 Not Modified when the client already has this version
+
+    The ETag is weak since the body may be sent compressed in any encoding
+    """
+    g.encoded_bodies = entry.encoded
+    headers = {
+        "ETag": f'W/"{entry.etag}"',
+        "Last-Modified": http_date(entry.last_modified),
+        "Cache-Control": "no-cache"
+    }
+    if request.if_none_match:
+        if request.if_none_match.contains_weak(entry.etag):
+            return "", 304, headers
+    elif request.if_modified_since is not None:
+        if request.if_modified_since.timestamp() >= int(entry.last_modified):
+            return "", 304, headers
+    return entry.body, 200, headers
+
+def streamed_success_response(chunks):
+    """
+    Success response sent chunk by chunk as chunks are produced, with the
+    request context (and database session) kept open until the last one
+    """
+    return app.response_class(stream_with_context(chunks), 200)
+
+def stream_events(query, head=None):
+    """
+    Streamed success response with every event in query in date order,
+    shaped like a single page with no next_cursor
+    """
+    events = iter_by_date(query.options(*Event.load_options()), Event)
+    return streamed_success_response(stream_json("events", events, Event.serialize, head, {"next_cursor": None}))
+
+def event_page_response(query, ttl=None, head=None):
+    """
+    Cached success response with one page of the events in query ordered
+    by date, paginated with ?limit= and ?cursor=
+
+    head adds fields to the body; ttl bounds how long the page is cached
+    when it depends on the current time
+    """
+    key = cache_key()
+    entry = response_cache.get(key)
+    if entry is None:
+        generation = response_cache.generation
+        try:
+            limit = parse_limit(request.args.get("limit"))
+            events, next_cursor = paginate_by_date(query.options(*Event.load_options()), Event, request.args.get("cursor"), limit)
+        except PaginationError as e:
+            return failure_response(str(e), 400)
+        body = json.dumps({
+            **(head or {}),
+            "events": [e.serialize() for e in events],
+            "next_cursor": next_cursor
+        })
+        entry = response_cache.set(key, body, {"events"} | event_tags(events), generation, ttl)
+    return cached_success_response(entry)
+
+def parse_timestamp(name):
+    """
+    Parses the epoch seconds in query parameter name, or None if absent
+    """
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an integer timestamp")
+
+def parse_date_range():
+    """
+    Parses the epoch seconds in ?from= and ?to=, each None if absent
+
+    Raises ValueError if either is not an integer or from is after to
+    """
+    start, end = parse_timestamp("from"), parse_timestamp("to")
+    if start is not None and end is not None and start > end:
+        raise ValueError("from must not be after to")
+    return start, end
+
+def weekend_window(now):
+    """
+    Returns (start, end) timestamps of this weekend, Saturday 00:00 to
+    Monday 00:00 in LOCAL_TIMEZONE, starting no earlier than now
+    """
+    local = datetime.datetime.fromtimestamp(now, LOCAL_TIMEZONE)
+    midnight = local.replace(hour=0, minute=0, second=0, microsecond=0)
+    # on Sunday the weekend started yesterday
+    days = -1 if local.weekday() == 6 else 5 - local.weekday()
+    saturday = midnight + datetime.timedelta(days=days)
+    monday = saturday + datetime.timedelta(days=2)
+    return max(now, int(saturday.timestamp())), int(monday.timestamp())
+
+def invalidate_image_events(asset):
+    """
+    Drops cached responses containing any event that shows asset
+    """
+    event_ids = db.session.query(Event.id).filter_by(image_id=asset.id)
+    response_cache.invalidate(*[f"event:{id}" for (id,) in event_ids])
+
+# eager-loading lookups used before serializing
+def get_user(user_id, *relationships, compact=False):
+    """
+    Gets a user by id with the relationship lists that serialization will
+    touch loaded in bulk (all four by default)
+    """
+    return User.query.options(*User.load_options(*relationships, compact=compact)).filter_by(id=user_id).first()
+
+def parse_user_fields(default_fields=USER_FIELDS):
+    """
+    Parses the query parameters ?fields= (comma separated field names,
+    default default_fields) and ?compact=1 (relationship lists as ids only)
+
+    Returns the fields and compact; raises ValueError naming unknown fields,
+    so routes that write can check before writing
+    """
+    fields = request.args.get("fields")
+    fields = default_fields if fields is None else [f for f in fields.split(",") if f]
+    unknown = [f for f in fields if f not in USER_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return fields, request.args.get("compact", "").lower() in ("1", "true")
+
+def user_response(user_id, fields, compact):
+    """
+    Success response serializing a user's fields, as parsed by
+    parse_user_fields
+
+    Only the relationship lists that are asked for are loaded
+    """
+    lists = [f for f in fields if f in USER_LISTS]
+    if lists:
+        user = get_user(user_id, *lists, compact=compact)
+    else:
+        user = User.query.filter_by(id=user_id).first()
+    if user is None:
+        return failure_response("User not found!")
+    return success_response(user.serialize(fields, compact))
+
+def extract_token():
+    """
+    Bearer token from the Authorization header of the current request, or
+    None if there is none
+    """
+    auth_header = request.headers.get("Authorization", "")
+    if not auth_header.startswith("Bearer "):
+        return None
+    return auth_header[len("Bearer "):].strip() or None
+
+def get_event(event_id):
+    """
+    Gets an event by id with its image and categories loaded
+    """
+    return Event.query.options(*Event.load_options()).filter_by(id=event_id).first()
+
 # -- GOOGLE ROUTES ------------------------------------------------------
 @app.route("/api/login/", methods=["POST"])
 def login():
     """
     Endpoint for logging a user in with Google and registering new users
+
+    Returns the user with a session token, to send as "Authorization:
+    Bearer <token>", and an update token for renewing the session
     """
     data = json.loads(request.data)
     token = data.get("token")
+    if token is None:
+        return failure_response("Missing token", 400)
     try:
-        
-        id_info = id_token.verify_oauth2_token(token, requests.Request(), os.environ.get("CLIENT_ID"))
-        email, first_name, last_name = id_info["email"], id_info["given_name"], id_info["family_name"]
-        name = first_name + " " + last_name
-        
-        user = User.query.filter_by(email=email).first()
+        id_info = google_login.verify_token(token, os.environ.get("CLIENT_ID"))
+    except ValueError:
+        return failure_response("Invalid token", 401)
+    except requests.RequestException:
+        return failure_response("Could not reach Google to verify the token", 503)
+    email, first_name, last_name = id_info["email"], id_info["given_name"], id_info["family_name"]
+    name = first_name + " " + last_name
 
-        if user is None:
-            # create user and session
-            user = User(email=email, name=name)
-            db.session.add(user)
-            db.session.commit()
+    user = User.query.filter_by(email=email).first()
 
-        return success_response(user.serialize())
-        # return session serialize
-    except ValueError:
-        raise Exception("Invalid Token")
+    if user is None:
+        # create user
+        user = User(email=email, name=name)
+        db.session.add(user)
+    session = users_dao.create_session(user)
+    db.session.commit()
+    return success_response({**user.serialize(LOGIN_FIELDS), **session})
+
+@app.route("/api/session/", methods=["POST"])
+def renew_session():
+    """
+    Endpoint for exchanging an update token, sent as "Authorization: Bearer
+    <token>", for a new session
+    """
+    update_token = extract_token()
+    if update_token is None:
+        return failure_response("Missing update token", 401)
+    try:
+        user, session = users_dao.renew_session(update_token)
+    except ValueError as e:
+        return failure_response(str(e), 401)
+    return success_response({"id": user.id, **session})
+
+@app.route("/api/logout/", methods=["POST"])
+def logout():
+    """
+    Endpoint for ending the session of the user the session token belongs to
+    """
+    session_token = extract_token()
+    user = None if session_token is None else users_dao.get_user_by_session_token(session_token)
+    if user is None:
+        return failure_response("Invalid session token", 401)
+    users_dao.end_session(user)
+    return success_response({"id": user.id})
+
+@app.route("/api/me/")
+def get_current_user():
+    """
+    Endpoint for getting the user the session token belongs to
+
+    Supports ?fields= and ?compact=1 like /api/users/<id>/
+    """
+    session_token = extract_token()
+    user_id = None if session_token is None else users_dao.get_user_id_by_session_token(session_token)
+    if user_id is None:
+        return failure_response("Invalid session token", 401)
+    try:
+        fields, compact = parse_user_fields()
+    except ValueError as e:
+        return failure_response(str(e), 400)
+    return user_response(user_id, fields, compact)
 
 @app.route("/api/users/<int:user_id>/phone/", methods=["POST"])
 def add_number(user_id):
     """
     Endpoint for adding phone number to user
+
+    Acknowledges with the user's id; ?fields= and ?compact=1 select more
     """
+    try:
+        fields, compact = parse_user_fields(MUTATION_FIELDS)
+    except ValueError as e:
+        return failure_response(str(e), 400)
     body = json.loads(request.data)
     number = body.get("number")
     if number is None:
@@ -100,7 +401,7 @@ def add_number(user_id):
         return failure_response("User not found", 404)
     user.number = number
     db.session.commit()
-    return success_response(user.serialize())
+    return user_response(user_id, fields, compact)
 
 
 # -- USER ROUTES ------------------------------------------------------
@@ -127,39 +428,233 @@ def create_user():
 def get_specific_user(user_id):
     """
     Endpoint for getting user by id 
+
+    Supports ?fields= and ?compact=1 to return less
     """
-    user = User.query.filter_by(id=user_id).first()
-    if user is None:
-        return failure_response("User not found!")
-    return success_response(user.serialize())
+    try:
+        fields, compact = parse_user_fields()
+    except ValueError as e:
+        return failure_response(str(e), 400)
+    return user_response(user_id, fields, compact)
 
 @app.route("/api/user/<int:user_id>/")
 def delete_user(user_id):
     """
     Endpoint for deleting a user 
     """
-    user = User.query.filter_by(id=user_id).first()
+    user = get_user(user_id)
     if user is None:
         return failure_response("User not found!")
+    serialized = user.serialize()
+    saved_ids = [e.id for e in user.saved_events]
+    recommend.forget_saves(user_id, saved_ids)
+    trending.forget_saves(user_id, saved_ids)
+    # ids are reused, so a new user must not inherit these
+    ReminderSent.query.filter_by(user_id=user_id).delete()
+    users_dao.forget_session(user)
     db.session.delete(user)
     db.session.commit()
-    return success_response(user.serialize())
+    response_cache.invalidate(f"user:{user_id}:saved_events", f"user:{user_id}:saved_buckets")
+    return success_response(serialized)
 
 
 # -- EVENT ROUTES ------------------------------------------------------
 @app.route("/api/events/")
 def get_all_events():
     """
-    Endpoint for getting all events
+    Endpoint for getting all events that have not happened yet, ordered
+    by date; ?include_past=1 includes past events
+
+    Paginated with ?limit= and the opaque ?cursor= returned as next_cursor;
+    ?limit=all streams every event instead
+    """
+    include_past = request.args.get("include_past", "").lower() in ("1", "true")
+    query = Event.query
+    if not include_past:
+        query = query.filter(Event.date >= int(time.time()))
+    if request.args.get("limit") == "all":
+        return stream_events(query)
+    return event_page_response(query, None if include_past else TIME_WINDOW_TTL)
+
+@app.route("/api/events/range/")
+def get_events_in_range():
+    """
+    Endpoint for getting events dated from ?from= up to (not including)
+    ?to=, both epoch seconds and either optional, ordered by date
+
+    Paginated with ?limit= and ?cursor=
+    """
+    try:
+        start, end = parse_date_range()
+    except ValueError as e:
+        return failure_response(str(e), 400)
+    if start is None and end is None:
+        return failure_response("Please pass from, to or both", 400)
+    query = Event.query
+    if start is not None:
+        query = query.filter(Event.date >= start)
+    if end is not None:
+        query = query.filter(Event.date < end)
+    return event_page_response(query)
+
+@app.route("/api/events/upcoming/")
+def get_upcoming_events():
+    """
+    Endpoint for getting events in the next ?within= seconds (default one
+    week), ordered by date
+
+    Paginated with ?limit= and ?cursor=
+    """
+    try:
+        within = int(request.args.get("within", UPCOMING_WINDOW))
+    except ValueError:
+        return failure_response("within must be an integer number of seconds", 400)
+    if within < 1:
+        return failure_response("within must be positive", 400)
+    now = int(time.time())
+    end = now + min(within, MAX_UPCOMING_WINDOW)
+    query = Event.query.filter(Event.date >= now, Event.date < end)
+    return event_page_response(query, TIME_WINDOW_TTL, {"from": now, "to": end})
+
+@app.route("/api/events/weekend/")
+def get_weekend_events():
+    """
+    Endpoint for getting the events of this weekend that have not happened
+    yet, ordered by date
+
+    Paginated with ?limit= and ?cursor=
     """
-    # return success_response({"events": [e.serialize() for e in Event.query.order_by(Event.date.desc())]})
-    return success_response({"events": [e.serialize() for e in Event.query.all()]})
-    
+    start, end = weekend_window(int(time.time()))
+    query = Event.query.filter(Event.date >= start, Event.date < end)
+    return event_page_response(query, TIME_WINDOW_TTL, {"from": start, "to": end})
+
+
+@app.route("/api/events/query/")
+def query_events():
+    """
+    Endpoint for filtering events by text, categories and date in one query
+
+    Takes ?q= (search text), ?categories= (comma separated ids) with
+    ?match=any (default) or ?match=all, and ?from= / ?to= (epoch seconds;
+    past events are left out unless from or ?include_past=1 is given).
+    Paginated by date with ?limit= and ?cursor=.
+
+    Also returns facets: the number of matching events in each category,
+    counting the text and date filters, and the category filter too with
+    match=all
+    """
+    text = request.args.get("q", "").strip()
+    match = request.args.get("match", "any")
+    if match not in ("any", "all"):
+        return failure_response("match must be any or all", 400)
+    try:
+        category_ids = sorted({int(id) for id in request.args.get("categories", "").split(",") if id})
+    except ValueError:
+        return failure_response("categories must be comma separated integer ids", 400)
+    try:
+        start, end = parse_date_range()
+    except ValueError as e:
+        return failure_response(str(e), 400)
+    if len(category_ids) > MAX_QUERY_CATEGORIES:
+        return failure_response(f"At most {MAX_QUERY_CATEGORIES} categories", 400)
+    relative = start is None and request.args.get("include_past", "").lower() not in ("1", "true")
+    if relative:
+        start = int(time.time())
+
+    filters = []
+    if text:
+        filters.append(search_filter(text))
+    if start is not None:
+        filters.append(Event.date >= start)
+    if end is not None:
+        filters.append(Event.date < end)
+    if category_ids:
+        in_categories = db.session.query(category_association_table.c.event_id) \
+            .filter(category_association_table.c.category_id.in_(category_ids))
+        if match == "all":
+            in_categories = in_categories.group_by(category_association_table.c.event_id) \
+                .having(db.func.count() == len(category_ids))
+        category_filter = Event.id.in_(in_categories.subquery())
+
+    key = cache_key()
+    entry = response_cache.get(key)
+    if entry is None:
+        generation = response_cache.generation
+        query = Event.query.filter(*filters)
+        if category_ids:
+            query = query.filter(category_filter)
+        try:
+            limit = parse_limit(request.args.get("limit"))
+            events, next_cursor = paginate_by_date(query.options(*Event.load_options()), Event, request.args.get("cursor"), limit)
+        except PaginationError as e:
+            return failure_response(str(e), 400)
+
+        # with match=any, each selected category would only count its own
+        # events, so facets show what selecting another category would add
+        matching = db.session.query(Event.id).filter(*filters)
+        if category_ids and match == "all":
+            matching = matching.filter(category_filter)
+        facets = db.session.query(category_association_table.c.category_id, db.func.count()) \
+            .filter(category_association_table.c.event_id.in_(matching.subquery())) \
+            .group_by(category_association_table.c.category_id) \
+            .order_by(db.func.count().desc(), category_association_table.c.category_id)
+        body = json.dumps({
+            "events": [e.serialize() for e in events],
+            "next_cursor": next_cursor,
+            "facets": [{"id": id, "count": count} for id, count in facets]
+        })
+        tags = {"events", "facets"} | event_tags(events)
+        entry = response_cache.set(key, body, tags, generation, TIME_WINDOW_TTL if relative else None)
+    return cached_success_response(entry)
+
+@app.route("/api/events/trending/")
+def get_trending_events():
+    """
+    Endpoint for getting the upcoming events saved most over the last few
+    days, most popular first, each with its score
+
+    Reads the ranking notify.py precomputes, see trending.py; paginated by
+    rank with ?limit= and ?cursor=
+    """
+    key = cache_key()
+    entry = response_cache.get(key)
+    if entry is None:
+        generation = response_cache.generation
+        try:
+            limit = parse_limit(request.args.get("limit"))
+            cursor = request.args.get("cursor")
+            (after,) = decode_cursor(cursor, size=1) if cursor else (0,)
+        except PaginationError as e:
+            return failure_response(str(e), 400)
+        ranking = TrendingEvent.query.filter(TrendingEvent.rank > after) \
+            .order_by(TrendingEvent.rank).limit(limit + 1).all()
+        next_cursor = encode_cursor(ranking[limit - 1].rank) if len(ranking) > limit else None
+        ranking = ranking[:limit]
+        events = {e.id: e for e in Event.query.options(*Event.load_options())
+                  .filter(Event.id.in_([r.event_id for r in ranking]))}
+        # save counts here may lag by up to TRENDING_TTL; saves do not
+        # invalidate the ranking
+        body = json.dumps({
+            "events": [
+                {**events[r.event_id].serialize(), "score": r.score, "save_count": events[r.event_id].save_count}
+                for r in ranking if r.event_id in events
+            ],
+            "next_cursor": next_cursor,
+            "computed_at": ranking[0].computed_at if ranking else None
+        })
+        tags = {"trending"} | event_tags(events.values())
+        entry = response_cache.set(key, body, tags, generation, trending.TRENDING_TTL)
+    return cached_success_response(entry)
+
 @app.route("/api/users/<int:user_id>/events/", methods=["POST"])
 def create_event(user_id):
     """
     Endpoint for creating a event
 
+    Takes either image_id, from uploading the image to /api/assets/ first,
+    or the image itself as base64 image_data. The image is processed in the
+    background: the response is 202 with image_status "pending" until it
+    is, and the final image URL can be polled at /api/assets/<image_id>/
     """
     # checks if user exists
     user = User.query.filter_by(id=user_id).first()
@@ -183,47 +678,164 @@ def create_event(user_id):
     if description is None:
         return failure_response("Please put something for the description", 400) 
     categories = body.get("categories")
+    image_id = body.get("image_id")
     image_data = body.get("image_data")
-    if image_data is None:
+    needs_processing = False
+    if image_id is not None:
+        image = Asset.query.filter_by(id=image_id).first()
+        if image is None:
+            return failure_response("Image not found!", 400)
+    elif image_data is None:
             return failure_response("No base64 image passed in!", 400)
-    
-    # creates image object 
-    image = Asset(image_data=image_data)
-    db.session.add(image)
-    db.session.commit()
-    
+    else:
+        # finds or creates image object, uploaded after the event is saved
+        try:
+            content_type, img_data = decode_image(image_data)
+            digest = hashlib.sha256(img_data).hexdigest()
+            image, needs_processing = Asset.find_or_create(content_type, digest)
+        except ValueError as e:
+            return failure_response(str(e), 400)
+
     # creates event object 
-    new_event = Event(title=title, date=date, host_name=host_name, location=location, description=description, image_id=image.id)
+    new_event = Event(title=title, date=date, host_name=host_name, location=location, description=description, image=image)
     db.session.add(new_event)
     # adds event to user created
     user.created_events.append(new_event)
     db.session.commit()
-    return success_response(new_event.serialize(), 201)
+    response_cache.invalidate("events")
+
+    if needs_processing:
+        process_in_background(image.id, BytesIO(img_data), invalidate_image_events)
+    new_event = get_event(new_event.id)
+    serialized = new_event.serialize()
+    serialized["image_id"] = new_event.image.id
+    serialized["image_status"] = new_event.image.status
+    return success_response(serialized, 202 if new_event.image.status == ASSET_PENDING else 201)
+
+@app.route("/api/assets/", methods=["POST"])
+def upload_asset():
+    """
+    Endpoint for uploading an image, either as multipart form data in the
+    "image" field or as the raw request body with an image Content-Type
+
+    The body is streamed in chunks and rejected with 413 past
+    MAX_UPLOAD_BYTES. Pass the returned id as image_id to create_event.
+    """
+    if request.content_length is not None and request.content_length > MAX_UPLOAD_BYTES:
+        return failure_response("Image is too large", 413)
+    if request.content_length is None:
+        # chunked: count the body as it is read, parsing included
+        request.environ["wsgi.input"] = LimitedUpload(request.environ["wsgi.input"], MAX_UPLOAD_BYTES)
+    if request.mimetype == "multipart/form-data":
+        try:
+            upload = request.files.get("image")
+        except RequestEntityTooLarge:
+            return failure_response("Image is too large", 413)
+        if upload is None:
+            return failure_response("No image passed in!", 400)
+        content_type = guess_type(upload.filename or "")[0] or upload.mimetype
+        # Werkzeug already spooled the file while parsing, so it is hashed
+        # in place rather than copied again; swapping in an empty stream
+        # keeps the request from closing it before it is processed
+        img_file, upload.stream = upload.stream, BytesIO()
+        digest, size = hash_upload(img_file)
+    else:
+        content_type = request.mimetype
+        try:
+            img_file, digest, size = spool_upload(request.stream, MAX_UPLOAD_BYTES)
+        except (UploadTooLarge, RequestEntityTooLarge):
+            return failure_response("Image is too large", 413)
+    if size == 0:
+        img_file.close()
+        return failure_response("Empty image", 400)
+    try:
+        image, needs_processing = Asset.find_or_create(content_type, digest)
+    except ValueError as e:
+        img_file.close()
+        return failure_response(str(e), 400)
+    db.session.commit()
+
+    if needs_processing:
+        process_in_background(image.id, img_file, invalidate_image_events)
+    else:
+        img_file.close()
+    return success_response(image.status_serialize(), 202 if image.status == ASSET_PENDING else 201)
+
+@app.route("/api/assets/<int:asset_id>/")
+def get_asset(asset_id):
+    """
+    Endpoint for getting an image and its processing status
+
+    An image whose processing was lost reports failed, so clients stop
+    polling; uploading it again processes it again
+    """
+    asset = Asset.query.filter_by(id=asset_id).first()
+    if asset is None:
+        return failure_response("Image not found!")
+    if asset.is_stale():
+        asset.status = ASSET_FAILED
+        db.session.commit()
+    return success_response(asset.status_serialize())
+
+@app.route("/api/events/saves/")
+def get_save_counts():
+    """
+    Endpoint for getting how many users saved each of ?ids= (comma
+    separated event ids), e.g. to show next to a page of events
+
+    Read fresh on every request from the maintained counters, one primary
+    key lookup per id, and not cached: saves happen far more often than
+    event edits, so the counts are kept out of the cached event bodies
+    """
+    try:
+        ids = {int(id) for id in request.args.get("ids", "").split(",") if id}
+    except ValueError:
+        return failure_response("ids must be comma separated integer ids", 400)
+    if len(ids) > MAX_BATCH_IDS:
+        return failure_response(f"At most {MAX_BATCH_IDS} ids", 400)
+    counts = db.session.query(Event.id, Event.save_count).filter(Event.id.in_(ids)) if ids else []
+    return success_response({"save_counts": {str(id): count for id, count in counts}})
 
 @app.route("/api/events/<int:event_id>/")
 def get_specific_event(event_id):
     """
     Endpoint for getting a event by id 
     """
-    # checks if event exists
-    event= Event.query.filter_by(id=event_id).first()
-    if event is None:
-        return failure_response("Sorry, event was not found.")
-    return success_response(event.serialize())
+    key = cache_key()
+    entry = response_cache.get(key)
+    if entry is None:
+        generation = response_cache.generation
+        # checks if event exists
+        event = get_event(event_id)
+        if event is None:
+            return failure_response("Sorry, event was not found.")
+        entry = response_cache.set(key, json.dumps(event.serialize()), event_tags([event]), generation)
+    return cached_success_response(entry)
 
 @app.route("/api/event/<string:search>/")
 def search_event(search):
     """
-    Endpoint for getting events by search 
+    Endpoint for getting events by search, best match first
+
+    Matches title, description, location and host name; paginated with
+    ?limit= and ?cursor=
     """
-    events = Event.query.all()
-    relevant = []
-    
-    for event in events:
-        event_title = event.title
-        if search.lower() in event_title.lower():
-            relevant.append(event)
-    return success_response({"events": [e.serialize() for e in relevant]})            
+    try:
+        limit = parse_limit(request.args.get("limit"))
+        cursor = request.args.get("cursor")
+        offset = decode_cursor(cursor, size=1)[0] if cursor is not None else 0
+    except PaginationError as e:
+        return failure_response(str(e), 400)
+    ids = search_event_ids(search, limit + 1, offset)
+    next_cursor = None
+    if len(ids) > limit:
+        ids = ids[:limit]
+        next_cursor = encode_cursor(offset + limit)
+    events = {e.id: e for e in Event.query.options(*Event.load_options()).filter(Event.id.in_(ids))}
+    return success_response({
+        "events": [events[id].serialize() for id in ids],
+        "next_cursor": next_cursor
+    })
 
 @app.route("/api/users/<int:user_id>/events/<int:event_id>/", methods=["DELETE"])
 def delete_event(user_id,event_id):
@@ -239,26 +851,58 @@ def delete_event(user_id,event_id):
     if event is None:
         return failure_response("Event not found!")
     # checks if user created the event
-    if event not in user.created_events:
+    if not has_association(created_events_association_table, created_events_id=user_id, users_created_id=event_id):
         return failure_response("User did not create this event!")
-    db.seswon.delete(event)
+    serialized = event.serialize()
+    category_ids = Category.remove_events([event_id])
+    recommend.forget_events([event_id])
+    trending.forget_events([event_id])
+    # ids are reused, so a new event must not inherit these
+    ReminderSent.query.filter_by(event_id=event_id).delete()
+    db.session.delete(event)
     db.session.commit()
-    return success_response(event.serialize())
+    response_cache.invalidate(f"event:{event_id}", "facets", *[f"category:{id}" for id in category_ids])
+    return success_response(serialized)
 
 @app.route("/api/events/random/")
 def get_random_event():
     """
     Endpoint for getting a random event
+
+    With ?count=N returns up to N distinct random events at once; ?exclude=
+    takes a comma separated list of up to MAX_BATCH_IDS event ids the
+    client has already seen
     """
-    list = Event.query.all() 
-    random.shuffle(list)
-    return success_response(list[0].serialize())
+    count = request.args.get("count")
+    exclude = request.args.get("exclude")
+    try:
+        exclude = [int(id) for id in exclude.split(",") if id] if exclude else []
+        if count is not None:
+            count = min(int(count), MAX_RANDOM_EVENTS)
+    except ValueError:
+        return failure_response("count and exclude must be integers", 400)
+    # every excluded id is a bound parameter of each probe
+    if len(exclude) > MAX_BATCH_IDS:
+        return failure_response(f"At most {MAX_BATCH_IDS} excluded ids", 400)
+    ids = Event.random_ids(1 if count is None else count, exclude)
+    events = {e.id: e for e in Event.query.options(*Event.load_options()).filter(Event.id.in_(ids))}
+    if count is not None:
+        return success_response({"events": [events[id].serialize() for id in ids]})
+    if not ids:
+        return failure_response("No events found!")
+    return success_response(events[ids[0]].serialize())
 
 @app.route("/api/users/<int:user_id>/events/<int:event_id>/bookmark/", methods=["POST"])
 def bookmark_event(event_id, user_id):
     """ 
     Endpoint for adding an event to user's saved events 
+
+    Acknowledges with the user's id; ?fields= and ?compact=1 select more
     """
+    try:
+        fields, compact = parse_user_fields(MUTATION_FIELDS)
+    except ValueError as e:
+        return failure_response(str(e), 400)
     # checks if user exist
     user = User.query.filter_by(id=user_id).first()
     if user is None:
@@ -268,19 +912,56 @@ def bookmark_event(event_id, user_id):
     event = Event.query.filter_by(id=event_id).first()
     if event is None:
         return failure_response("Event not found!")
-    user.saved_events.append(event)
-    db.session.commit()
-    return success_response(user.serialize())
+    if add_association(saved_events_association_table, saved_event_id=user_id, users_saved_id=event_id,
+                       saved_at=int(time.time())):
+        recommend.record_saves(user_id, [event_id])
+        trending.record_saves(user_id, [event_id])
+        db.session.commit()
+        response_cache.invalidate(f"user:{user_id}:saved_events")
+    return user_response(user_id, fields, compact)
+
+@app.route("/api/users/<int:user_id>/recommendations/")
+def get_recommendations(user_id):
+    """
+    Endpoint for getting upcoming events often saved together with the
+    user's saved events, best first, each with its score
+
+    Answered from the precomputed similarity lists; ?limit= sets how many
+    """
+    key = cache_key()
+    entry = response_cache.get(key)
+    if entry is None:
+        generation = response_cache.generation
+        if User.query.filter_by(id=user_id).first() is None:
+            return failure_response("User not found!")
+        try:
+            limit = parse_limit(request.args.get("limit"))
+        except PaginationError as e:
+            return failure_response(str(e), 400)
+        scores = dict(recommend.recommended_event_ids(user_id, limit))
+        events = Event.query.options(*Event.load_options()).filter(Event.id.in_(scores)).all()
+        events.sort(key=lambda e: (-scores[e.id], e.id))
+        body = json.dumps({"events": [{**e.serialize(), "score": scores[e.id]} for e in events]})
+        # other users' saves change the scores too, so entries also expire
+        tags = {"recommendations", f"user:{user_id}:saved_events"} | event_tags(events)
+        entry = response_cache.set(key, body, tags, generation, TIME_WINDOW_TTL)
+    return cached_success_response(entry)
 
 @app.route("/api/users/<int:user_id>/events/bookmark/")
 def get_all_bookmark_current(user_id):
     """
     Endpoint for getting all bookmarked current events
     """
-    user = User.query.filter_by(id=user_id).first()
-    if user is None:
-        return failure_response("User not found!")
-    return success_response(user.serialize_saved_events()) 
+    key = cache_key()
+    entry = response_cache.get(key)
+    if entry is None:
+        generation = response_cache.generation
+        user = get_user(user_id, "saved_events")
+        if user is None:
+            return failure_response("User not found!")
+        tags = {f"user:{user_id}:saved_events"} | event_tags(user.saved_events)
+        entry = response_cache.set(key, json.dumps(user.serialize_saved_events()), tags, generation)
+    return cached_success_response(entry)
 
 @app.route("/api/users/<int:user_id>/events/<int:event_id>/bookmark/", methods=["DELETE"])
 def delete_bookmark_current(user_id, event_id):
@@ -293,10 +974,11 @@ def delete_bookmark_current(user_id, event_id):
     event = Event.query.filter_by(id=event_id).first()
     if event is None:
         return failure_response("Event not found!")
-    for event in user.saved_events:
-        if event.id==event_id:
-            user.saved_events.remove(event)
-    db.session.commit()
+    recommend.forget_saves(user_id, [event_id])
+    trending.forget_saves(user_id, [event_id])
+    if remove_association(saved_events_association_table, saved_event_id=user_id, users_saved_id=event_id):
+        db.session.commit()
+        response_cache.invalidate(f"user:{user_id}:saved_events")
     return success_response(event.serialize(), 200)
 
 
@@ -307,7 +989,7 @@ def get_completed_buckets(user_id):
     """
     Endpoint for getting all Bucket items
     """
-    user = User.query.filter_by(id=user_id).first()
+    user = get_user(user_id, "completed_bucket_list")
     if user is None:
         return failure_response("User not found!")
     return success_response(user.serialize_completed_buckets())
@@ -316,7 +998,13 @@ def get_completed_buckets(user_id):
 def bookmark_bucket(bucket_id, user_id):
     """ 
     Endpoint for adding a bucket to user's saved buckets
+
+    Acknowledges with the user's id; ?fields= and ?compact=1 select more
     """
+    try:
+        fields, compact = parse_user_fields(MUTATION_FIELDS)
+    except ValueError as e:
+        return failure_response(str(e), 400)
     # checks if user exist
     user = User.query.filter_by(id=user_id).first()
     if user is None:
@@ -326,19 +1014,26 @@ def bookmark_bucket(bucket_id, user_id):
     bucket = Bucket.query.filter_by(id=bucket_id).first()
     if bucket is None:
         return failure_response("Event not found!")
-    user.saved_buckets.append(bucket)
-    db.session.commit()
-    return success_response(user.serialize())
+    if add_association(saved_buckets_association_table, saved_bucket_id=user_id, users_saved_id=bucket_id):
+        db.session.commit()
+        response_cache.invalidate(f"user:{user_id}:saved_buckets")
+    return user_response(user_id, fields, compact)
 
 @app.route("/api/users/<int:user_id>/buckets/bookmark/")
 def get_all_bookmark_bucket(user_id):
     """
     Endpoint for getting all bookmarked bucket events
     """
-    user = User.query.filter_by(id=user_id).first()
-    if user is None:
-        return failure_response("User not found!")
-    return success_response(user.serialize_saved_buckets()) 
+    key = cache_key()
+    entry = response_cache.get(key)
+    if entry is None:
+        generation = response_cache.generation
+        user = get_user(user_id, "saved_buckets")
+        if user is None:
+            return failure_response("User not found!")
+        tags = {f"user:{user_id}:saved_buckets"}
+        entry = response_cache.set(key, json.dumps(user.serialize_saved_buckets()), tags, generation)
+    return cached_success_response(entry)
 
 @app.route("/api/users/<int:user_id>/buckets/<int:bucket_id>/bookmark/", methods=["DELETE"])
 def delete_bookmark_bucket(user_id, bucket_id):
@@ -351,17 +1046,22 @@ def delete_bookmark_bucket(user_id, bucket_id):
     bucket = Bucket.query.filter_by(id=bucket_id).first()
     if bucket is None:
         return failure_response("Bucket not found!")
-    for bucket in user.saved_buckets:
-        if bucket.id==bucket_id:
-            user.saved_buckets.remove(bucket)
-    db.session.commit()
+    if remove_association(saved_buckets_association_table, saved_bucket_id=user_id, users_saved_id=bucket_id):
+        db.session.commit()
+        response_cache.invalidate(f"user:{user_id}:saved_buckets")
     return success_response(bucket.serialize())
 
 @app.route("/api/users/<int:user_id>/buckets/<int:bucket_id>/completed/", methods=["POST"])
 def complete_bucket(bucket_id, user_id):
     """ 
     Endpoint for adding a bucket to user's completed buckets 
+
+    Acknowledges with the user's id; ?fields= and ?compact=1 select more
     """
+    try:
+        fields, compact = parse_user_fields(MUTATION_FIELDS)
+    except ValueError as e:
+        return failure_response(str(e), 400)
     # checks if user exist
     user = User.query.filter_by(id=user_id).first()
     if user is None:
@@ -371,9 +1071,97 @@ def complete_bucket(bucket_id, user_id):
     bucket = Bucket.query.filter_by(id=bucket_id).first()
     if bucket is None:
         return failure_response("Event not found!")
-    user.completed_bucket_list.append(bucket)
+    if add_association(user_bucket_list_association_table, user_bucket_list_id=user_id, bucket_user_list_id=bucket_id):
+        db.session.commit()
+    return user_response(user_id, fields, compact)
+
+
+# -- BATCH ROUTES ------------------------------------------------------
+# operation name -> (association table, user column, item column, item model, adds rows)
+BATCH_OPERATIONS = {
+    "bookmark_events": (saved_events_association_table, "saved_event_id", "users_saved_id", Event, True),
+    "unbookmark_events": (saved_events_association_table, "saved_event_id", "users_saved_id", Event, False),
+    "bookmark_buckets": (saved_buckets_association_table, "saved_bucket_id", "users_saved_id", Bucket, True),
+    "unbookmark_buckets": (saved_buckets_association_table, "saved_bucket_id", "users_saved_id", Bucket, False),
+    "complete_buckets": (user_bucket_list_association_table, "user_bucket_list_id", "bucket_user_list_id", Bucket, True),
+}
+
+def apply_batch(user_id, operation, ids):
+    """
+    Adds or removes the association rows between a user and items for one
+    batch operation with one multi-row statement
+
+    Returns the result per id: "added", "removed", "unchanged" or "not_found"
+    """
+    table, user_column, item_column, model, adds = BATCH_OPERATIONS[operation]
+    found = {id for (id,) in db.session.query(model.id).filter(model.id.in_(ids))}
+    present = {id for (id,) in db.session.query(table.c[item_column])
+               .filter(table.c[user_column] == user_id, table.c[item_column].in_(found))}
+    changed = found - present if adds else present
+    # saved events also feed the co-bookmark counts behind recommendations
+    # and the popularity counters
+    counted = table is saved_events_association_table
+    if changed and adds:
+        extra = {"saved_at": int(time.time())} if counted else {}
+        db.session.execute(table.insert().prefix_with("OR IGNORE").values(
+            [{user_column: user_id, item_column: id, **extra} for id in changed]
+        ))
+        if counted:
+            recommend.record_saves(user_id, changed)
+            trending.record_saves(user_id, changed)
+    elif changed:
+        if counted:
+            recommend.forget_saves(user_id, changed)
+            trending.forget_saves(user_id, changed)
+        db.session.execute(table.delete().where(
+            (table.c[user_column] == user_id) & table.c[item_column].in_(changed)
+        ))
+    results = {}
+    for id in ids:
+        if id not in found:
+            results[str(id)] = "not_found"
+        elif id in changed:
+            results[str(id)] = "added" if adds else "removed"
+        else:
+            results[str(id)] = "unchanged"
+    return results
+
+@app.route("/api/users/<int:user_id>/batch/", methods=["POST"])
+def batch_update(user_id):
+    """
+    Endpoint for bookmarking, unbookmarking and completing many events and
+    buckets at once, in one transaction
+
+    Takes lists of ids under any of the keys of BATCH_OPERATIONS, e.g.
+    {"bookmark_events": [1, 2], "complete_buckets": [3]}, and returns the
+    result for every id under the same keys
+    """
+    user = User.query.filter_by(id=user_id).first()
+    if user is None:
+        return failure_response("User not found!")
+    body = json.loads(request.data)
+    if not isinstance(body, dict):
+        return failure_response("Body must be an object of operations", 400)
+    unknown = [key for key in body if key not in BATCH_OPERATIONS]
+    if unknown:
+        return failure_response(f"Unknown operations: {', '.join(unknown)}", 400)
+    for ids in body.values():
+        if not isinstance(ids, list) or not all(type(id) is int for id in ids):
+            return failure_response("Operations take lists of integer ids", 400)
+        if len(ids) > MAX_BATCH_IDS:
+            return failure_response(f"At most {MAX_BATCH_IDS} ids per operation", 400)
+
+    results = {operation: apply_batch(user_id, operation, ids) for operation, ids in body.items()}
     db.session.commit()
-    return success_response(user.serialize())
+    changed = {
+        operation for operation, result in results.items()
+        if any(r in ("added", "removed") for r in result.values())
+    }
+    if changed & {"bookmark_events", "unbookmark_events"}:
+        response_cache.invalidate(f"user:{user_id}:saved_events")
+    if changed & {"bookmark_buckets", "unbookmark_buckets"}:
+        response_cache.invalidate(f"user:{user_id}:saved_buckets")
+    return success_response(results)
 
 
 @app.route("/api/events/<int:event_id>/category/<int:category_id>/", methods=["POST"])
@@ -387,20 +1175,81 @@ def assign_category(event_id, category_id):
         return failure_response("Event not found!")
     # checks if category exist
     category = Category.query.filter_by(id=category_id).first()
-    if event is None:
+    if category is None:
         return failure_response("Category not found!")
-    event.categories.append(category)
-    db.session.commit()
-    return success_response(event.serialize())
+    if category.add_event(event_id):
+        db.session.commit()
+        response_cache.invalidate(f"event:{event_id}", f"category:{category_id}", "facets")
+    return success_response(get_event(event_id).serialize())
 
 @app.route("/api/category/<int:category_id>/")
 def get_events_in_category(category_id):
     """ 
-    Endpoint for getting events in a category
+    Endpoint for getting events in a category, ordered by date
+
+    Paginated with ?limit= and the opaque ?cursor= returned as next_cursor;
+    ?limit=all streams every event instead
     """
-    # checks if category exist
-    category = Category.query.filter_by(id=category_id).first()
-    return success_response(category.serialize())
+    streamed = request.args.get("limit") == "all"
+    key = cache_key()
+    entry = None if streamed else response_cache.get(key)
+    if entry is None:
+        generation = response_cache.generation
+        # checks if category exist
+        category = Category.query.filter_by(id=category_id).first()
+        if category is None:
+            return failure_response("Category not found!")
+        query = Event.query \
+            .join(category_association_table, category_association_table.c.event_id == Event.id) \
+            .filter(category_association_table.c.category_id == category_id)
+        if streamed:
+            return stream_events(query, category.count_serialize())
+        query = query.options(*Event.load_options())
+        try:
+            limit = parse_limit(request.args.get("limit"))
+            events, next_cursor = paginate_by_date(query, Event, request.args.get("cursor"), limit)
+        except PaginationError as e:
+            return failure_response(str(e), 400)
+        body = json.dumps({
+            **category.count_serialize(),
+            "events": [e.serialize() for e in events],
+            "next_cursor": next_cursor
+        })
+        tags = {f"category:{category_id}"} | event_tags(events)
+        entry = response_cache.set(key, body, tags, generation)
+    return cached_success_response(entry)
+
+@app.route("/api/categories/")
+def get_categories():
+    """
+    Endpoint for getting all categories with their number of events
+
+    Paginated with ?limit= and the opaque ?cursor= returned as next_cursor
+    """
+    try:
+        limit = parse_limit(request.args.get("limit"))
+        cursor = request.args.get("cursor")
+        after = decode_cursor(cursor, size=1)[0] if cursor is not None else 0
+    except PaginationError as e:
+        return failure_response(str(e), 400)
+    categories = Category.query.filter(Category.id > after).order_by(Category.id).limit(limit + 1).all()
+    next_cursor = None
+    if len(categories) > limit:
+        categories = categories[:limit]
+        next_cursor = encode_cursor(categories[-1].id)
+    return success_response({
+        "categories": [c.count_serialize() for c in categories],
+        "next_cursor": next_cursor
+    })
+
+# -- METRICS ROUTES ------------------------------------------------------
+@app.route("/metrics")
+def get_metrics():
+    """
+    Endpoint for Prometheus to scrape request and SQL metrics from
+    """
+    return metrics.metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,435 @@
+# code to benchmark every route in app.py
+#
+# drives the app in-process through the Flask test client against a copy
+# of the database in bukethaca.db (fill it with seed.py first) and reports, per
+# endpoint, throughput, p50/p95/p99 latency and SQL statements per request.
+# Results are written as JSON; pass --compare with an earlier results file to
+# see how each endpoint moved between commits, e.g.
+#
+#   python seed.py --reset && python bench.py --requests 300 --workers 4
+#   python bench.py --compare bench-1a2b3c4.json
+#
+# Every run starts from a fresh copy of the seeded database in a temporary
+# directory, which also holds images uploaded during the run, so the rows
+# and files write endpoints leave behind never reach the next run and runs
+# on different commits measure the same data. Login is not benchmarked
+# since it needs a real Google token; the session routes use tokens minted
+# directly with users_dao.create_session instead.
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from PIL import Image
+
+os.environ.setdefault("STORAGE_BACKEND", "local")
+
+from sqlalchemy import event as sa_event
+
+from seed import WORDS
+
+# statements executed by the current thread's request
+_counter = threading.local()
+
+
+def count_statement(*args):
+    """
+    SQLAlchemy before_cursor_execute listener counting statements per thread
+    """
+    _counter.statements = getattr(_counter, "statements", 0) + 1
+
+
+class Case:
+    """
+    One benchmarked endpoint
+
+    path, body and headers are functions of (rng, ids, state) returning the
+    request path, body and headers; the body is sent as JSON unless
+    content_type is given. setup, if given, is run through the client
+    before each measured request and returns the state passed to them.
+    """
+
+    def __init__(self, name, method, path, body=None, setup=None, content_type=None, headers=None):
+        """
+        Initializes a case
+        """
+        self.name = name
+        self.method = method
+        self.path = path
+        self.body = body
+        self.setup = setup
+        self.content_type = content_type
+        self.headers = headers
+
+    def request(self, rng, ids, state):
+        """
+        Returns the path and test client arguments of one request
+        """
+        path = self.path(rng, ids, state)
+        kwargs = {"method": self.method}
+        if self.headers is not None:
+            kwargs["headers"] = self.headers(rng, ids, state)
+        if self.body is None:
+            return path, kwargs
+        body = self.body(rng, ids, state)
+        if self.content_type is None:
+            return path, {**kwargs, "json": body}
+        return path, {**kwargs, "data": body, "content_type": self.content_type}
+
+
+def event_body(rng, ids, state):
+    """
+    Returns a body for creating an event with an existing image
+    """
+    return {
+        "title": " ".join(rng.sample(WORDS, 3)),
+        "host_name": "bench",
+        "date": int(time.time()) + rng.randint(60, 90 * 24 * 60 * 60),
+        "location": "bench",
+        "description": " ".join(rng.sample(WORDS, 10)),
+        "image_id": rng.choice(ids["assets"]),
+    }
+
+
+def png_body(rng, ids, state):
+    """
+    Returns a small PNG that differs on every call, so every upload is
+    stored and processed rather than deduplicated
+    """
+    data = BytesIO()
+    Image.new("RGB", (64, 64), tuple(rng.randrange(256) for _ in range(3))).save(data, "PNG")
+    return data.getvalue()
+
+
+def date_window(rng):
+    """
+    Returns a random (from, to) window of up to 30 days in the next 90
+    """
+    start = int(time.time()) + rng.randint(0, 90 * 24 * 60 * 60)
+    return start, start + rng.randint(1, 30 * 24 * 60 * 60)
+
+
+def random_user(rng, ids):
+    """
+    Returns the id of a random user
+    """
+    return rng.choice(ids["users"])
+
+
+def start_session(user_id):
+    """
+    Returns new session and update tokens for user_id, minted without a
+    Google login
+    """
+    import app as application
+    import users_dao
+    from db import db, User
+    with application.app.app_context():
+        tokens = users_dao.create_session(User.query.filter_by(id=user_id).first())
+        db.session.commit()
+    return tokens
+
+
+def bearer(token_name):
+    """
+    Returns a Case headers function sending state[token_name] as a bearer
+    token
+    """
+    return lambda rng, ids, state: {"Authorization": f"Bearer {state[token_name]}"}
+
+
+def cases():
+    """
+    Returns a Case for every benchmarked endpoint
+    """
+    def bookmark_setup(kind, method):
+        # picks a (user, item) pair and puts it in the state the measured
+        # request expects
+        def setup(client, rng, ids):
+            state = {"user": random_user(rng, ids), "item": rng.choice(ids[kind])}
+            client.open(f"/api/users/{state['user']}/{kind}/{state['item']}/bookmark/", method=method)
+            return state
+        return setup
+
+    def created_event(client, rng, ids):
+        user_id = random_user(rng, ids)
+        response = client.post(f"/api/users/{user_id}/events/", json=event_body(rng, ids, None))
+        return {"user": user_id, "event": json.loads(response.data)["id"]}
+
+    def created_user(client, rng, ids):
+        email = f"bench-{rng.getrandbits(64):x}@cornell.edu"
+        return json.loads(client.post("/api/users/", json={"name": "bench", "email": email}).data)
+
+    def session(client, rng, ids):
+        # a user of its own, so concurrent workers never end each other's
+        # sessions
+        user_id = created_user(client, rng, ids)["id"]
+        return {"id": user_id, **start_session(user_id)}
+
+    def cached_session(client, rng, ids):
+        # a session looked up once already, as it is on every request after
+        # a client's first
+        state = session(client, rng, ids)
+        client.get("/api/me/", headers=bearer("session_token")(rng, ids, state))
+        return state
+
+    def batch(rng, ids, state):
+        return {
+            "bookmark_events": rng.sample(ids["events"], min(10, len(ids["events"]))),
+            "unbookmark_events": rng.sample(ids["events"], min(10, len(ids["events"]))),
+            "complete_buckets": rng.sample(ids["buckets"], min(5, len(ids["buckets"]))),
+        }
+
+    return [
+        Case("list_events", "GET", lambda rng, ids, s: "/api/events/"),
+        Case("stream_events", "GET", lambda rng, ids, s: "/api/events/?limit=all"),
+        Case("upcoming_events", "GET", lambda rng, ids, s: "/api/events/upcoming/"),
+        Case("weekend_events", "GET", lambda rng, ids, s: "/api/events/weekend/"),
+        Case("events_in_range", "GET", lambda rng, ids, s: "/api/events/range/?from=%d&to=%d" % date_window(rng)),
+        Case("query_events", "GET", lambda rng, ids, s: "/api/events/query/?q=%s&categories=%s" % (
+            rng.choice(WORDS), ",".join(str(id) for id in rng.sample(ids["categories"], min(2, len(ids["categories"])))))),
+        Case("get_event", "GET", lambda rng, ids, s: f"/api/events/{rng.choice(ids['events'])}/"),
+        Case("random_event", "GET", lambda rng, ids, s: "/api/events/random/"),
+        Case("random_events", "GET", lambda rng, ids, s: "/api/events/random/?count=10"),
+        Case("search_events", "GET", lambda rng, ids, s: f"/api/event/{rng.choice(WORDS)}/"),
+        Case("category_events", "GET", lambda rng, ids, s: f"/api/category/{rng.choice(ids['categories'])}/"),
+        Case("stream_category_events", "GET",
+             lambda rng, ids, s: f"/api/category/{rng.choice(ids['categories'])}/?limit=all"),
+        Case("list_categories", "GET", lambda rng, ids, s: "/api/categories/"),
+        Case("get_user", "GET", lambda rng, ids, s: f"/api/users/{random_user(rng, ids)}/"),
+        Case("get_user_compact", "GET", lambda rng, ids, s: f"/api/users/{random_user(rng, ids)}/?compact=1"),
+        Case("saved_events", "GET", lambda rng, ids, s: f"/api/users/{random_user(rng, ids)}/events/bookmark/"),
+        Case("recommendations", "GET", lambda rng, ids, s: f"/api/users/{random_user(rng, ids)}/recommendations/"),
+        Case("trending_events", "GET", lambda rng, ids, s: "/api/events/trending/"),
+        Case("save_counts", "GET", lambda rng, ids, s: "/api/events/saves/?ids=%s" % ",".join(
+            str(id) for id in rng.sample(ids["events"], min(20, len(ids["events"]))))),
+        Case("saved_buckets", "GET", lambda rng, ids, s: f"/api/users/{random_user(rng, ids)}/buckets/bookmark/"),
+        Case("completed_buckets", "GET", lambda rng, ids, s: f"/api/users/{random_user(rng, ids)}/buckets/"),
+        Case("get_asset", "GET", lambda rng, ids, s: f"/api/assets/{rng.choice(ids['assets'])}/"),
+        Case("metrics", "GET", lambda rng, ids, s: "/metrics"),
+        Case("me", "GET", lambda rng, ids, s: "/api/me/", setup=cached_session, headers=bearer("session_token")),
+        Case("me_uncached", "GET", lambda rng, ids, s: "/api/me/", setup=session, headers=bearer("session_token")),
+        Case("renew_session", "POST", lambda rng, ids, s: "/api/session/", setup=session,
+             headers=bearer("update_token")),
+        Case("logout", "POST", lambda rng, ids, s: "/api/logout/", setup=session, headers=bearer("session_token")),
+        Case("create_user", "POST", lambda rng, ids, s: "/api/users/",
+             body=lambda rng, ids, s: {"name": "bench", "email": f"bench-{rng.getrandbits(64):x}@cornell.edu"}),
+        Case("delete_user", "GET", lambda rng, ids, s: f"/api/user/{s['id']}/", setup=created_user),
+        Case("add_number", "POST", lambda rng, ids, s: f"/api/users/{random_user(rng, ids)}/phone/",
+             body=lambda rng, ids, s: {"number": rng.randint(2000000000, 9999999999)}),
+        Case("create_event", "POST", lambda rng, ids, s: f"/api/users/{random_user(rng, ids)}/events/", body=event_body),
+        Case("delete_event", "DELETE", lambda rng, ids, s: f"/api/users/{s['user']}/events/{s['event']}/",
+             setup=created_event),
+        Case("upload_asset", "POST", lambda rng, ids, s: "/api/assets/", body=png_body, content_type="image/png"),
+        Case("assign_category", "POST",
+             lambda rng, ids, s: f"/api/events/{rng.choice(ids['events'])}/category/{rng.choice(ids['categories'])}/"),
+        Case("bookmark_event", "POST", lambda rng, ids, s: f"/api/users/{s['user']}/events/{s['item']}/bookmark/",
+             setup=bookmark_setup("events", "DELETE")),
+        Case("unbookmark_event", "DELETE", lambda rng, ids, s: f"/api/users/{s['user']}/events/{s['item']}/bookmark/",
+             setup=bookmark_setup("events", "POST")),
+        Case("bookmark_bucket", "POST", lambda rng, ids, s: f"/api/users/{s['user']}/buckets/{s['item']}/bookmark/",
+             setup=bookmark_setup("buckets", "DELETE")),
+        Case("unbookmark_bucket", "DELETE", lambda rng, ids, s: f"/api/users/{s['user']}/buckets/{s['item']}/bookmark/",
+             setup=bookmark_setup("buckets", "POST")),
+        Case("complete_bucket", "POST",
+             lambda rng, ids, s: f"/api/users/{random_user(rng, ids)}/buckets/{rng.choice(ids['buckets'])}/completed/"),
+        Case("batch", "POST", lambda rng, ids, s: f"/api/users/{random_user(rng, ids)}/batch/", body=batch),
+    ]
+
+
+def load_ids():
+    """
+    Returns the ids of the rows requests are made against
+    """
+    from db import db, Asset, Bucket, Category, Event, User
+    now = int(time.time())
+    ids = {
+        "users": [row[0] for row in db.session.query(User.id)],
+        "events": [row[0] for row in db.session.query(Event.id).filter(Event.date >= now)],
+        "categories": [row[0] for row in db.session.query(Category.id)],
+        "buckets": [row[0] for row in db.session.query(Bucket.id)],
+        "assets": [row[0] for row in db.session.query(Asset.id)],
+    }
+    empty = [name for name, values in ids.items() if not values]
+    if empty:
+        raise SystemExit(f"No {', '.join(empty)} to benchmark against; run seed.py first")
+    return ids
+
+
+def percentile(values, p):
+    """
+    Returns the p-th percentile of sorted values (nearest rank)
+    """
+    index = max(0, min(len(values) - 1, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def run_case(app, case, ids, requests, workers, warmup, seed):
+    """
+    Sends requests measured requests for case to app from workers threads
+
+    Returns the stats for the endpoint
+    """
+    def worker(n, count):
+        rng = random.Random(f"{seed}:{case.name}:{n}")
+        client = app.test_client()
+        timings = []
+        errors = 0
+        for i in range(warmup + count):
+            state = case.setup(client, rng, ids) if case.setup else None
+            path, kwargs = case.request(rng, ids, state)
+            _counter.statements = 0
+            start = time.perf_counter()
+            response = client.open(path, **kwargs)
+            # streamed bodies are only generated as they are read
+            response.get_data()
+            elapsed = time.perf_counter() - start
+            if i < warmup:
+                continue
+            timings.append((elapsed, _counter.statements))
+            errors += response.status_code >= 400
+        return timings, errors
+
+    shares = [requests // workers + (n < requests % workers) for n in range(workers)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(worker, range(workers), shares))
+    wall = time.perf_counter() - start
+
+    timings = [t for worker_timings, errors in results for t in worker_timings]
+    latencies = sorted(elapsed * 1000 for elapsed, statements in timings)
+    return {
+        "requests": len(timings),
+        "errors": sum(errors for worker_timings, errors in results),
+        "throughput_rps": round(len(timings) / wall, 1),
+        "mean_ms": round(sum(latencies) / len(latencies), 3),
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p95_ms": round(percentile(latencies, 95), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "sql_per_request": round(sum(statements for elapsed, statements in timings) / len(timings), 2),
+    }
+
+
+def git_commit():
+    """
+    Returns the short hash of the checked out commit, or None outside git
+    """
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new):
+    """
+    Prints how every endpoint in both result sets changed
+    """
+    print(f"\n{'endpoint':<20} {'p50 ms':>16} {'p95 ms':>16} {'sql/req':>14}")
+    for name, stats in new["endpoints"].items():
+        before = old["endpoints"].get(name)
+        if before is None:
+            continue
+        columns = []
+        for key in ("p50_ms", "p95_ms", "sql_per_request"):
+            change = (stats[key] - before[key]) / before[key] * 100 if before[key] else 0
+            columns.append(f"{stats[key]:>8} {change:+6.1f}%")
+        print(f"{name:<20} {columns[0]:>16} {columns[1]:>16} {columns[2]:>14}")
+
+
+def parse_args():
+    """
+    Parses the command line
+    """
+    parser = argparse.ArgumentParser(description="Benchmark every route in app.py")
+    parser.add_argument("--requests", type=int, default=100, help="measured requests per endpoint")
+    parser.add_argument("--workers", type=int, default=1, help="concurrent client threads")
+    parser.add_argument("--warmup", type=int, default=5, help="unmeasured requests per worker first")
+    parser.add_argument("--only", nargs="*", help="endpoints to run, by name")
+    parser.add_argument("--no-cache", action="store_true", help="disable the response cache")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="results file (default bench-<commit>.json)")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    return parser.parse_args()
+
+
+def copy_database(workdir):
+    """
+    Copies the seeded database into workdir and points the app, and local
+    image storage, there; must run before the app is imported
+    """
+    os.environ.setdefault("LOCAL_STORAGE_DIR", os.path.join(workdir, "uploads"))
+    from db import database_path
+    source = database_path()
+    if not os.path.exists(source):
+        raise SystemExit(f"No database at {source}; run seed.py first")
+    copy = os.path.join(workdir, os.path.basename(source))
+    shutil.copyfile(source, copy)
+    os.environ["DB_FILENAME"] = copy
+
+
+def main():
+    """
+    Runs the benchmark from the command line
+    """
+    args = parse_args()
+    commit = git_commit()
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    try:
+        copy_database(workdir)
+        results = run(args, commit)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    output = args.output or f"bench-{commit or 'local'}.json"
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+def run(args, commit):
+    """
+    Benchmarks every selected endpoint and returns the results
+    """
+    import app as application
+    from db import db
+    if args.no_cache:
+        application.response_cache.max_entries = 0
+    with application.app.app_context():
+        engine = db.engine
+        # statement logging would dominate the timings
+        engine.echo = False
+        ids = load_ids()
+    sa_event.listen(engine, "before_cursor_execute", count_statement)
+
+    endpoints = {}
+    for case in cases():
+        if args.only and case.name not in args.only:
+            continue
+        endpoints[case.name] = stats = run_case(application.app, case, ids, args.requests, args.workers, args.warmup, args.seed)
+        print(f"{case.name:<20} {stats['throughput_rps']:>9} req/s  p50 {stats['p50_ms']:>8} ms  "
+              f"p95 {stats['p95_ms']:>8} ms  p99 {stats['p99_ms']:>8} ms  "
+              f"{stats['sql_per_request']:>6} sql/req  {stats['errors']} errors")
+
+    return {
+        "commit": commit,
+        "timestamp": int(time.time()),
+        "config": vars(args),
+        "data": {name: len(values) for name, values in ids.items()},
+        "endpoints": endpoints,
+    }
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+In-process response cache for read endpoints
+
+Entries are serialized response bodies keyed by route and query parameters.
+Each entry carries tags naming the rows it was built from (e.g. "event:3"),
+and write endpoints invalidate exactly the tags they touch. Other processes
+writing to the database (notify.py) record the tags they touch in the
+cache_invalidations table, which the app polls. The cache is bounded and
+evicts the least recently used entry when full.
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+# encoded holds the body compressed per Content-Encoding, filled in on demand
+CacheEntry = namedtuple("CacheEntry", ["body", "etag", "last_modified", "tags", "expires", "encoded"])
+
+
+class ResponseCache:
+    """
+    Bounded LRU cache of response bodies with tag based invalidation
+    """
+
+    def __init__(self, max_entries=512):
+        """
+        Initializes an empty cache holding at most max_entries responses
+        """
+        self.max_entries = max_entries
+        # bumped by every invalidation so that bodies built from data read
+        # before a write are not stored after it
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._keys_by_tag = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the live entry for key, or None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires is not None and entry.expires < time.time():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, body, tags=(), generation=None, ttl=None):
+        """
+        Stores body under key and returns its entry
+
+        generation should be read before building body; if an invalidation
+        happened since, the entry is returned but not stored
+        """
+        now = time.time()
+        entry = CacheEntry(
+            body=body,
+            etag=hashlib.sha1(body.encode()).hexdigest(),
+            last_modified=now,
+            tags=frozenset(tags),
+            expires=None if ttl is None else now + ttl,
+            encoded={}
+        )
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return entry
+            self._remove(key)
+            self._entries[key] = entry
+            for tag in entry.tags:
+                self._keys_by_tag.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+        return entry
+
+    def invalidate(self, *tags):
+        """
+        Drops every entry carrying any of tags
+        """
+        with self._lock:
+            self.generation += 1
+            for tag in tags:
+                for key in list(self._keys_by_tag.get(tag, ())):
+                    self._remove(key)
+
+    def clear(self):
+        """
+        Drops every entry
+        """
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self._keys_by_tag.clear()
+
+    def _remove(self, key):
+        """
+        Removes key and its tag references; the lock must be held
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry.tags:
+            keys = self._keys_by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_tag[tag]
+
+
+def event_tags(events):
+    """
+    Returns the cache tags for a list of serialized events
+    """
+    return {f"event:{e.id}" for e in events}
@@ -0,0 +1,95 @@
+"""
+Response compression
+
+Compresses text responses with brotli or gzip, whichever the client
+prefers in Accept-Encoding. brotli is used only when the brotli package is
+installed. Bodies smaller than COMPRESS_MIN_BYTES are sent as is, since
+compressing them costs more than it saves; streamed responses are always
+compressed, chunk by chunk.
+"""
+
+import gzip
+import os
+import zlib
+
+from flask import g, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", 1024))
+GZIP_LEVEL = int(os.environ.get("GZIP_LEVEL", 6))
+# brotli's fast range; higher qualities cost too much time per request
+BROTLI_QUALITY = int(os.environ.get("BROTLI_QUALITY", 4))
+COMPRESSIBLE_TYPES = ("application/json", "text/html", "text/plain")
+ENCODINGS = ["br", "gzip"] if brotli is not None else ["gzip"]
+
+
+def compress(data, encoding):
+    """
+    Returns data (bytes) compressed with encoding
+    """
+    if encoding == "br":
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, GZIP_LEVEL)
+
+
+def compress_stream(chunks, encoding):
+    """
+    Compresses an iterable of chunks, flushing after every chunk so the
+    client can start decoding before the response ends
+    """
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        for chunk in chunks:
+            yield compressor.process(chunk.encode() if isinstance(chunk, str) else chunk) + compressor.flush()
+        yield compressor.finish()
+    else:
+        # wbits 31 writes a gzip header and trailer around the deflate data
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        for chunk in chunks:
+            yield compressor.compress(chunk.encode() if isinstance(chunk, str) else chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+
+
+def compress_response(response):
+    """
+    Compresses response in the encoding negotiated with the client
+
+    Views may set g.encoded_bodies to a dict kept alongside the body (e.g.
+    in its cache entry) to compress each body once per encoding
+    """
+    if response.mimetype not in COMPRESSIBLE_TYPES or response.direct_passthrough \
+            or response.status_code < 200 or response.status_code in (204, 304) \
+            or "Content-Encoding" in response.headers:
+        return response
+    response.vary.add("Accept-Encoding")
+    encoding = request.accept_encodings.best_match(ENCODINGS)
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_BYTES:
+            return response
+        encoded = g.get("encoded_bodies")
+        if encoded is None:
+            data = compress(data, encoding)
+        else:
+            if encoding not in encoded:
+                encoded[encoding] = compress(data, encoding)
+            data = encoded[encoding]
+        response.set_data(data)
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def init_app(app):
+    """
+    Compresses every eligible response from app
+    """
+    app.after_request(compress_response)
@@ -2,53 +2,193 @@ import code
 from flask_sqlalchemy import SQLAlchemy
 
 import base64
-import boto3
 import datetime
 import io
 from io import BytesIO
 from mimetypes import guess_extension, guess_type
 import os
-from PIL import Image
+from PIL import Image, ImageOps
 import random
 import re
 import string
+import time
 
 import hashlib
 
 from sqlalchemy import ForeignKey
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload, selectinload
 import bcrypt
 
+from storage import get_storage
+
 db = SQLAlchemy()
 
+def database_path():
+    """
+    Absolute path of the SQLite database shared by app.py, notify.py,
+    seed.py and bench.py: DB_FILENAME (default bukethaca.db), relative to
+    this directory, so it does not depend on the working directory
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), os.environ.get("DB_FILENAME", "bukethaca.db"))
+
+# statements run on startup to bring databases created by older versions
+# of db.create_all() up to date; every statement must be idempotent
+SCHEMA_UPGRADES = [
+    "CREATE INDEX IF NOT EXISTS ix_events_date_id ON events (date, id)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_assets_content_hash ON assets (content_hash)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_users_session_token ON users (session_token)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_users_update_token ON users (update_token)",
+]
+
+RECOUNT_CATEGORY_EVENTS = (
+    "UPDATE categories SET event_count = "
+    "(SELECT count(*) FROM association_category WHERE category_id = categories.id)"
+)
+
+RECOUNT_EVENT_SAVES = (
+    "UPDATE events SET save_count = "
+    "(SELECT count(*) FROM association_saved_events WHERE users_saved_id = events.id)"
+)
+
+# columns added to tables after they were first created, as
+# (table, column, definition[, backfill statement]); added before
+# SCHEMA_UPGRADES run, with the backfill run once right after the column
+SCHEMA_COLUMNS = [
+    ("assets", "status", "VARCHAR NOT NULL DEFAULT 'ready'"),
+    ("assets", "variants", "VARCHAR"),
+    ("assets", "content_hash", "VARCHAR"),
+    ("categories", "event_count", "INTEGER NOT NULL DEFAULT 0", RECOUNT_CATEGORY_EVENTS),
+    ("users", "session_token", "VARCHAR"),
+    ("users", "session_expiration", "INTEGER"),
+    ("users", "update_token", "VARCHAR"),
+    ("association_saved_events", "saved_at", "INTEGER"),
+    ("events", "save_count", "INTEGER NOT NULL DEFAULT 0", RECOUNT_EVENT_SAVES),
+    ("assets", "processing_started", "INTEGER"),
+]
+
+def upgrade_schema():
+    """
+    Applies SCHEMA_COLUMNS, migrate_association_tables and SCHEMA_UPGRADES
+    to the current database
+    """
+    for table, column, definition, *backfill in SCHEMA_COLUMNS:
+        existing = {row[1] for row in db.session.execute(f"PRAGMA table_info({table})")}
+        if column not in existing:
+            db.session.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+            for statement in backfill:
+                db.session.execute(statement)
+    migrate_association_tables()
+    for statement in SCHEMA_UPGRADES:
+        db.session.execute(statement)
+    db.session.commit()
+
+# every association table has a composite primary key, so a pair can only
+# be stored once, plus an index on the reverse pair for lookups from the
+# other side
 category_association_table = db.Table(
     "association_category",
-    db.Column("event_id", db.Integer, db.ForeignKey("events.id")), 
-    db.Column("category_id", db.Integer, db.ForeignKey("categories.id"))
+    db.Column("event_id", db.Integer, db.ForeignKey("events.id"), primary_key=True), 
+    db.Column("category_id", db.Integer, db.ForeignKey("categories.id"), primary_key=True),
+    db.Index("ix_association_category_reverse", "category_id", "event_id")
     )
 
 user_bucket_list_association_table =db.Table(
     "association_user_bucket_list", 
-    db.Column("user_bucket_list_id", db.Integer, db.ForeignKey("users.id")), 
-    db.Column("bucket_user_list_id", db.Integer, db.ForeignKey("buckets.id"))
+    db.Column("user_bucket_list_id", db.Integer, db.ForeignKey("users.id"), primary_key=True), 
+    db.Column("bucket_user_list_id", db.Integer, db.ForeignKey("buckets.id"), primary_key=True),
+    db.Index("ix_association_user_bucket_list_reverse", "bucket_user_list_id", "user_bucket_list_id")
 )
 saved_events_association_table = db.Table(
     "association_saved_events", 
-    db.Column("saved_event_id", db.Integer, db.ForeignKey("users.id")),
-    db.Column("users_saved_id", db.Integer, db.ForeignKey("events.id"))
+    db.Column("saved_event_id", db.Integer, db.ForeignKey("users.id"), primary_key=True),
+    db.Column("users_saved_id", db.Integer, db.ForeignKey("events.id"), primary_key=True),
+    # when the event was saved; NULL for saves made before it was recorded
+    db.Column("saved_at", db.Integer, nullable=True),
+    db.Index("ix_association_saved_events_reverse", "users_saved_id", "saved_event_id")
     )
 
 saved_buckets_association_table = db.Table(
     "association_saved_buckets",
-    db.Column("saved_bucket_id", db.Integer, db.ForeignKey("users.id")),
-    db.Column("users_saved_id", db.Integer, db.ForeignKey("buckets.id"))
+    db.Column("saved_bucket_id", db.Integer, db.ForeignKey("users.id"), primary_key=True),
+    db.Column("users_saved_id", db.Integer, db.ForeignKey("buckets.id"), primary_key=True),
+    db.Index("ix_association_saved_buckets_reverse", "users_saved_id", "saved_bucket_id")
     )
 
 created_events_association_table = db.Table(
     "association_created_events",
-    db.Column("created_events_id", db.Integer, db.ForeignKey("users.id")),
-    db.Column("users_created_id", db.Integer, db.ForeignKey("events.id"))
+    db.Column("created_events_id", db.Integer, db.ForeignKey("users.id"), primary_key=True),
+    db.Column("users_created_id", db.Integer, db.ForeignKey("events.id"), primary_key=True),
+    db.Index("ix_association_created_events_reverse", "users_created_id", "created_events_id")
     )
 
+ASSOCIATION_TABLES = [
+    category_association_table,
+    user_bucket_list_association_table,
+    saved_events_association_table,
+    saved_buckets_association_table,
+    created_events_association_table,
+]
+
+def migrate_association_tables():
+    """
+    Rebuilds association tables created without a primary key, dropping
+    duplicate and half-empty rows on the way, and recounts category events
+    and event saves if their table was rebuilt
+    """
+    for table in ASSOCIATION_TABLES:
+        columns = list(db.session.execute(f"PRAGMA table_info({table.name})"))
+        if not columns or any(column[5] for column in columns):
+            continue
+        names = ", ".join(column.name for column in table.columns)
+        not_null = " AND ".join(f"{column.name} IS NOT NULL" for column in table.primary_key.columns)
+        db.session.execute(f"ALTER TABLE {table.name} RENAME TO {table.name}_old")
+        table.create(bind=db.session.connection())
+        db.session.execute(
+            f"INSERT OR IGNORE INTO {table.name} ({names}) "
+            f"SELECT {names} FROM {table.name}_old WHERE {not_null}"
+        )
+        db.session.execute(f"DROP TABLE {table.name}_old")
+        if table is category_association_table:
+            db.session.execute(RECOUNT_CATEGORY_EVENTS)
+        if table is saved_events_association_table:
+            db.session.execute(RECOUNT_EVENT_SAVES)
+
+def add_association(table, **values):
+    """
+    Inserts an association row unless it already exists; returns whether
+    it was inserted
+    """
+    return db.session.execute(table.insert().prefix_with("OR IGNORE").values(**values)).rowcount == 1
+
+def remove_association(table, **values):
+    """
+    Deletes an association row; returns whether it existed
+    """
+    condition = db.and_(*[table.c[name] == value for name, value in values.items()])
+    return db.session.execute(table.delete().where(condition)).rowcount > 0
+
+def has_association(table, **values):
+    """
+    Whether an association row exists, as a single primary key lookup
+    """
+    condition = db.and_(*[table.c[name] == value for name, value in values.items()])
+    return db.session.query(db.exists().where(condition)).scalar()
+
+# seconds a session token stays valid
+SESSION_LIFETIME = int(os.environ.get("SESSION_LIFETIME", 24 * 60 * 60))
+
+def hash_token(token):
+    """
+    Hash under which a session or update token is stored; the tokens
+    themselves are only ever handed to the client
+    """
+    return hashlib.sha256(token.encode()).hexdigest()
+
+# fields User.serialize can return, and which of them are relationship lists
+USER_FIELDS = ("id", "name", "email", "number", "saved_events", "saved_buckets", "created_events", "completed_bucket_list")
+USER_LISTS = ("saved_events", "saved_buckets", "created_events", "completed_bucket_list")
+
 class User(db.Model):
     """
     User model 
@@ -60,12 +200,35 @@ class User(db.Model):
     name = db.Column(db.String, nullable=False)
     email = db.Column(db.String, nullable=False, unique=True)
     number = db.Column(db.Integer, nullable=True)
+    # sha256 hashes of the current tokens, see hash_token
+    session_token = db.Column(db.String, nullable=True, unique=True, index=True)
+    session_expiration = db.Column(db.Integer, nullable=True)
+    update_token = db.Column(db.String, nullable=True, unique=True, index=True)
 
     saved_events = db.relationship("Event", secondary=saved_events_association_table, back_populates="users_saved")
     saved_buckets = db.relationship("Bucket", secondary=saved_buckets_association_table, back_populates="users_saved")
     created_events = db.relationship("Event", secondary=created_events_association_table, back_populates="users_created")
     completed_bucket_list = db.relationship("Bucket", secondary=user_bucket_list_association_table, back_populates="users_completed")
 
+    @staticmethod
+    def load_options(*relationships, compact=False):
+        """
+        Loader options that fetch the given relationship lists (all four by
+        default) and everything their serialization touches in bulk
+
+        With compact, only the lists themselves are loaded
+        """
+        if not relationships:
+            relationships = USER_LISTS
+        options = []
+        for name in relationships:
+            relationship = getattr(User, name)
+            if name in ("saved_events", "created_events") and not compact:
+                options.extend(Event.load_options(relationship))
+            else:
+                options.append(selectinload(relationship))
+        return options
+
     def _init_(self, **kwargs):
         """
         Initialize User object/entry
@@ -73,21 +236,46 @@ class User(db.Model):
         self.name = kwargs.get("name")
         self.email = kwargs.get("email")
 
-    def serialize(self):
+    def serialize(self, fields=USER_FIELDS, compact=False):
         """
         Serializes User object
+
+        fields limits the output to the named USER_FIELDS; with compact the
+        relationship lists hold ids instead of serialized items
+        """
+        data = {}
+        for field in fields:
+            value = getattr(self, field)
+            if field in USER_LISTS:
+                value = [item.id if compact else item.serialize() for item in value]
+            data[field] = value
+        return data
+
+    def renew_session(self):
+        """
+        Issues a new session token and update token, replacing the old ones
+
+        Returns the tokens and the session's expiration time
         """
+        session_token = base64.urlsafe_b64encode(os.urandom(32)).decode().rstrip("=")
+        update_token = base64.urlsafe_b64encode(os.urandom(32)).decode().rstrip("=")
+        self.session_token = hash_token(session_token)
+        self.update_token = hash_token(update_token)
+        self.session_expiration = int(time.time()) + SESSION_LIFETIME
         return {
-            "id": self.id,
-            "name": self.name,
-            "email": self.email,
-            "number": self.number,
-            "saved_events": [e.serialize() for e in self.saved_events], 
-            "saved_buckets": [b.serialize() for b in self.saved_buckets],
-            "created_events": [c.serialize() for c in self.created_events], 
-            "completed_bucket_list": [u.serialize() for u in self.completed_bucket_list]
+            "session_token": session_token,
+            "session_expiration": self.session_expiration,
+            "update_token": update_token
         }
 
+    def end_session(self):
+        """
+        Invalidates the current session and update tokens
+        """
+        self.session_token = None
+        self.update_token = None
+        self.session_expiration = None
+
     def serialize_completed_buckets(self):
         """
         serialize completed buckets
@@ -138,10 +326,63 @@ class Event(db.Model):
     location = db.Column(db.String, nullable=False)
     description = db.Column(db.String, nullable=False)
     image_id = db.Column(db.Integer, db.ForeignKey("assets.id"), nullable=False)
+    # number of users who saved the event, kept up to date by trending.py
+    # rather than counted per request; served by /api/events/saves/ rather
+    # than serialize(), so saves do not invalidate cached event listings
+    save_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+
+    # (date, id) is the sort key for keyset pagination of event listings
+    __table_args__ = (db.Index("ix_events_date_id", "date", "id"),)
 
     categories = db.relationship("Category", secondary=category_association_table, back_populates="events")
     users_saved = db.relationship("User", secondary=saved_events_association_table, back_populates="saved_events")
     users_created = db.relationship("User", secondary=created_events_association_table, back_populates="created_events")
+    image = db.relationship("Asset")
+
+    @staticmethod
+    def load_options(relationship=None):
+        """
+        Loader options that fetch the image and categories of every event in
+        a result with a fixed number of statements
+
+        Pass relationship to load events reached through another model
+        """
+        if relationship is None:
+            return [joinedload(Event.image), selectinload(Event.categories)]
+        return [
+            selectinload(relationship).joinedload(Event.image),
+            selectinload(relationship).selectinload(Event.categories)
+        ]
+
+    @staticmethod
+    def random_ids(count=1, exclude=()):
+        """
+        Returns up to count distinct random event ids, skipping exclude
+
+        Each pick probes a random point between the smallest and largest id
+        and takes the nearest id at or after it, wrapping around to the
+        smallest id, so it is an index seek rather than a table scan. Gaps
+        left by deleted or excluded events make the ids after them slightly
+        more likely.
+        """
+        low, high = db.session.query(func.min(Event.id), func.max(Event.id)).first()
+        if low is None:
+            return []
+        seen = set(exclude)
+        ids = []
+        for _ in range(count):
+            candidates = db.session.query(Event.id)
+            if seen:
+                candidates = candidates.filter(Event.id.notin_(seen))
+            probe = random.randint(low, high)
+            # past the largest remaining id, wrap around to the smallest
+            row = candidates.filter(Event.id >= probe).order_by(Event.id).first() \
+                or candidates.order_by(Event.id).first()
+            if row is None:
+                break
+            ids.append(row[0])
+            seen.add(row[0])
+        return ids
 
     def _init_(self, **kwargs):
         """
@@ -158,7 +399,6 @@ class Event(db.Model):
         """
         Serializes Event object
         """
-        asset = Asset.query.filter_by(id=self.image_id).first()
         return {
             "id": self.id,
             "title": self.title,
@@ -166,8 +406,9 @@ class Event(db.Model):
             "date": self.date,
             "location": self.location,
             "description": self.description,
-            "categories": [c.serialize() for c in self.categories],
-            "image": asset.serialize(),
+            "categories": [c.simple_serialize() for c in self.categories],
+            "image": self.image.serialize(),
+            "image_variants": self.image.serialize_variants(),
             "type": "event"
         }
 
@@ -185,6 +426,114 @@ class Event(db.Model):
         }
         
 
+class ReminderSent(db.Model):
+    """
+    ReminderSent model
+
+    One row per (user, event) reminder texted, so notify.py never texts a
+    user twice about the same event
+    """
+    __tablename__ = "reminders_sent"
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), primary_key=True)
+    event_id = db.Column(db.Integer, db.ForeignKey("events.id"), primary_key=True)
+    sent_at = db.Column(db.Integer, nullable=False)
+
+
+class EventSaveBucket(db.Model):
+    """
+    EventSaveBucket model
+
+    How many times an event was saved during one hour (epoch seconds //
+    3600), the sliding-window counters trending.py ranks events by
+    """
+    __tablename__ = "event_save_buckets"
+    __table_args__ = (db.Index("ix_event_save_buckets_hour", "hour"),)
+    event_id = db.Column(db.Integer, db.ForeignKey("events.id"), primary_key=True)
+    hour = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+
+class TrendingEvent(db.Model):
+    """
+    TrendingEvent model
+
+    The latest trending ranking computed by trending.py, one row per rank
+    """
+    __tablename__ = "trending_events"
+    rank = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    event_id = db.Column(db.Integer, db.ForeignKey("events.id"), nullable=False)
+    score = db.Column(db.Float, nullable=False)
+    computed_at = db.Column(db.Integer, nullable=False)
+
+
+# seconds cache_invalidations rows are kept for the app to pick up
+CACHE_INVALIDATION_RETENTION = int(os.environ.get("CACHE_INVALIDATION_RETENTION", 60 * 60))
+
+class CacheInvalidation(db.Model):
+    """
+    CacheInvalidation model
+
+    A response cache tag invalidated by a process other than the app, e.g.
+    notify.py purging events. app.py polls for new rows and drops the
+    cached responses carrying the tag
+    """
+    __tablename__ = "cache_invalidations"
+    id = db.Column(db.Integer, primary_key=True)
+    tag = db.Column(db.String, nullable=False)
+    created_at = db.Column(db.Integer, nullable=False)
+
+    @staticmethod
+    def publish(tags, now=None):
+        """
+        Records tags as invalidated; the caller commits
+        """
+        now = int(time.time()) if now is None else now
+        rows = [{"tag": tag, "created_at": now} for tag in set(tags)]
+        if rows:
+            db.session.execute(CacheInvalidation.__table__.insert(), rows)
+
+    @staticmethod
+    def latest_id():
+        """
+        Returns the id of the newest row, or 0
+        """
+        return db.session.query(func.max(CacheInvalidation.id)).scalar() or 0
+
+    @staticmethod
+    def since(last_id):
+        """
+        Returns the id of the newest row and the tags recorded after the
+        row last_id, with a primary key range scan
+        """
+        rows = db.session.query(CacheInvalidation.id, CacheInvalidation.tag) \
+            .filter(CacheInvalidation.id > last_id).order_by(CacheInvalidation.id).all()
+        if not rows:
+            return last_id, set()
+        return rows[-1][0], {tag for id, tag in rows}
+
+    @staticmethod
+    def prune(before):
+        """
+        Deletes rows recorded before the epoch second before
+        """
+        return CacheInvalidation.query.filter(CacheInvalidation.created_at < before).delete()
+
+
+class EventSimilarity(db.Model):
+    """
+    EventSimilarity model
+
+    How many users saved both event_id and similar_id, stored in both
+    directions. recommend.py keeps the counts current as events are saved
+    and unsaved, and trims every event to its top-K rows on rebuild
+    """
+    __tablename__ = "event_similarities"
+    __table_args__ = (db.Index("ix_event_similarities_similar_id", "similar_id"),)
+    event_id = db.Column(db.Integer, db.ForeignKey("events.id"), primary_key=True)
+    similar_id = db.Column(db.Integer, db.ForeignKey("events.id"), primary_key=True)
+    co_count = db.Column(db.Integer, nullable=False, default=0)
+
+
 class Bucket(db.Model):
     """
     Bucket model 
@@ -221,6 +570,9 @@ class Category(db.Model):
 
     __tablename__ = "categories"
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    # number of events in the category, kept up to date by add_event and
+    # remove_events rather than counted per request
+    event_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
     events = db.relationship("Event", secondary=category_association_table, back_populates="categories")
     
     def _init_(self, **kwargs):
@@ -228,6 +580,31 @@ class Category(db.Model):
         Initialize Category object/entry
         """
 
+    def add_event(self, event_id):
+        """
+        Adds an event to this category and counts it; returns False if the
+        event was already in the category
+        """
+        if not add_association(category_association_table, event_id=event_id, category_id=self.id):
+            return False
+        db.session.execute(Category.__table__.update().where(Category.id == self.id)
+                           .values(event_count=Category.event_count + 1))
+        return True
+
+    @staticmethod
+    def remove_events(event_ids):
+        """
+        Uncounts events that are about to be deleted from every category
+        they are in; returns the ids of those categories
+        """
+        table = category_association_table
+        counts = db.session.query(table.c.category_id, func.count()) \
+            .filter(table.c.event_id.in_(event_ids)).group_by(table.c.category_id).all()
+        for category_id, count in counts:
+            db.session.execute(Category.__table__.update().where(Category.id == category_id)
+                               .values(event_count=Category.event_count - count))
+        return [category_id for category_id, count in counts]
+
     def serialize(self):
         """
         Serializes a Category object 
@@ -237,32 +614,151 @@ class Category(db.Model):
             "events": [e.serialize() for e in self.events]
         }
 
+    def count_serialize(self):
+        """
+        Serializes a Category object with its number of events
+        """
+        return {
+            "id": self.id,
+            "event_count": self.event_count
+        }
+
+    def simple_serialize(self):
+        """
+        Serializes a Category object without its events
+        """
+        return {
+            "id": self.id
+        }
+
 
 EXTENSIONS = ["png", "gif", "jpg", "jpeg"]
-BASE_DIR = os.getcwd()
-S3_BUCKET_NAME = os.environ.get("S3_BUCKET_NAME")
-S3_BASE_URL = f"https://{S3_BUCKET_NAME}.s3.us-east-2.amazonaws.com" 
+ASSET_PENDING = "pending"
+ASSET_READY = "ready"
+ASSET_FAILED = "failed"
+# a pending asset whose processing started longer ago than this was lost,
+# e.g. queued in a process that restarted, and is processed again
+ASSET_PROCESSING_TIMEOUT = int(os.environ.get("ASSET_PROCESSING_TIMEOUT", 10 * 60))
+# resized copies generated for every upload, as name -> longest side in pixels
+IMAGE_VARIANTS = {"thumbnail": 160, "card": 480, "full": 1280}
+VARIANT_FORMAT = "webp"
+VARIANT_QUALITY = 80
+
+def decode_image(image_data):
+    """
+    Splits an image in base64 form into its content type and decoded bytes
+
+    Raises ValueError if image_data is not valid base64
+    """
+    content_type = guess_type(image_data)[0]
+    #remove header of base64 string
+    img_str = re.sub("^data:image/.+;base64,", "", image_data)
+    img_data = base64.b64decode(img_str)
+    if not img_data:
+        raise ValueError("Empty image")
+    return content_type, img_data
+
+def image_extension(content_type):
+    """
+    File extension for an image's content type
+
+    Raises ValueError if the filetype is not supported
+    """
+    ext = guess_extension(content_type)[1:] if content_type else None
+
+    #only accepts supported file types
+    if ext not in EXTENSIONS:
+        raise ValueError(f"Unsupported file type: {ext}")
+    return ext
 
 class Asset(db.Model):
     """
     Asset Model
 
     Has a one-to-one relationship with Event table
+
+    Images are decoded and uploaded in the background, so an asset starts
+    out pending, with a final URL but no dimensions yet
     """
     __tablename__ = "assets"
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     base_url = db.Column(db.String, nullable=True)
     salt =  db.Column(db.String, nullable=False)
     extension =  db.Column(db.String, nullable=False)
-    width = db.Column(db.Integer, nullable=False)
-    height = db.Column(db.Integer, nullable=False)
-
-    def __init__(self,**kwargs):
-        """
-        Initializes an Asset object/entry
-        """
-        self.event_id = kwargs.get("event_id")
-        self.create(kwargs.get("image_data"))
+    width = db.Column(db.Integer, nullable=False, default=0)
+    height = db.Column(db.Integer, nullable=False, default=0)
+    status = db.Column(db.String, nullable=False, default=ASSET_READY, server_default=ASSET_READY)
+    # comma separated names of the IMAGE_VARIANTS generated for this image
+    variants = db.Column(db.String, nullable=True)
+    # SHA-256 of the image bytes, shared by every event posting that image
+    content_hash = db.Column(db.String, nullable=True, unique=True, index=True)
+    # when the image was last handed to processing, for finding lost ones
+    processing_started = db.Column(db.Integer, nullable=True)
+
+    @classmethod
+    def find_or_create(cls, content_type, digest):
+        """
+        Returns (asset, needs_processing) for an image whose bytes have the
+        SHA-256 hex digest digest
+
+        Identical images share one Asset, found by their digest, so each
+        distinct image is stored and uploaded once. A new
+        asset is inserted pending with INSERT OR IGNORE, so concurrent
+        uploads of the same image cannot create two. needs_processing is
+        True when the caller must process() the image: the asset is new, an
+        earlier attempt failed, or it has been pending longer than
+        ASSET_PROCESSING_TIMEOUT. Retries are claimed with a conditional
+        UPDATE, so only one concurrent upload processes the image again.
+
+        Raises ValueError if the filetype is not supported
+        """
+        image_extension(content_type)
+        now = int(time.time())
+        asset = cls.query.filter_by(content_hash=digest).first()
+        if asset is not None:
+            if asset.status != ASSET_FAILED and not asset.is_stale(now):
+                return asset, False
+            retry = db.or_(cls.status == ASSET_FAILED, cls.stale_condition(now))
+            result = db.session.execute(cls.__table__.update().where((cls.id == asset.id) & retry).values(
+                status=ASSET_PENDING,
+                processing_started=now
+            ))
+            db.session.refresh(asset)
+            return asset, result.rowcount == 1
+
+        new = cls()
+        new.prepare(content_type)
+        result = db.session.execute(cls.__table__.insert().prefix_with("OR IGNORE").values(
+            base_url=new.base_url,
+            salt=new.salt,
+            extension=new.extension,
+            width=new.width,
+            height=new.height,
+            status=new.status,
+            content_hash=digest,
+            processing_started=new.processing_started
+        ))
+        return cls.query.filter_by(content_hash=digest).first(), result.rowcount == 1
+
+    @classmethod
+    def stale_condition(cls, now):
+        """
+        SQL condition matching assets whose processing was lost
+        """
+        return (cls.status == ASSET_PENDING) & db.or_(
+            cls.processing_started.is_(None),
+            cls.processing_started < now - ASSET_PROCESSING_TIMEOUT
+        )
+
+    def is_stale(self, now=None):
+        """
+        Whether the asset has been pending longer than
+        ASSET_PROCESSING_TIMEOUT, so its processing was lost
+        """
+        now = int(time.time()) if now is None else now
+        return self.status == ASSET_PENDING and (
+            self.processing_started is None or self.processing_started < now - ASSET_PROCESSING_TIMEOUT
+        )
 
     def serialize(self):
         """
@@ -270,76 +766,87 @@ class Asset(db.Model):
         """
         return f"{self.base_url}/{self.salt}.{self.extension}"
 
-    def event_serialize(self):
+    def serialize_variants(self):
         """
-        Serialize Asset object
+        Serialize the URLs of the resized copies of the image by name
         """
-        return f"{self.base_url}/{self.salt}.{self.extension}"
+        if not self.variants:
+            return {}
+        return {
+            name: f"{self.base_url}/{self.variant_filename(name)}"
+            for name in self.variants.split(",")
+        }
 
-    def create(self, image_data):
+    def variant_filename(self, name):
         """
-        Given an image in base64 form, it
-        1. Rejects the image is the filetype is not supported file type
-        2. Generates a random string for the image file name
-        3. Decodes the image and attempts to upload it to AWS
+        File name of the resized copy of the image called name
         """
-        try:
-            ext = guess_extension(guess_type(image_data)[0])[1:]
-
-            #only accepts supported file types
-            if ext not in EXTENSIONS:
-                raise Exception(f"Unsupported file type: {ext}")
-
+        return f"{self.salt}_{name}.{VARIANT_FORMAT}"
 
-            #generate random strong name for file
-            salt = "".join(
-                random.SystemRandom().choice(
-                    string.ascii_uppercase+ string.digits
-                )
-                for _ in range(16)
-            )
-
-            #decode the image and upload to aws
-            #remove header of base64 string
-            img_str = re.sub("^data:image/.+;base64,", "", image_data)
-            img_data = base64.b64decode(img_str)
-            img = Image.open(BytesIO(img_data))
-
-            self.base_url = S3_BASE_URL
-            self.salt = salt
-            self.extension = ext
-            self.width = img.width
-            self.height = img.height
-
-            img_filename = f"{self.salt}.{self.extension}"
-            self.upload(img, img_filename)
-
-        except Exception as e:
-            print(f"Error when creating image: {e}")
-
-    def upload(self, img, img_filename):
+    def status_serialize(self):
         """
-        Attempt to upload the image to the specified S3 bucket
+        Serialize Asset object with its processing status
         """
-        try:
-            # save image temporarily on server
-            img_temploc = f"{BASE_DIR}/{img_filename}"
-            img.save(img_temploc)
-            
-            # upload image to S3
-            s3_client = boto3.client("s3")
-            s3_client.upload_file(img_temploc, S3_BUCKET_NAME, img_filename)
-
-            # make s3 image url is public
-            s3_resource = boto3.resource("s3")
-            object_acl = s3_resource.ObjectAcl(S3_BUCKET_NAME, img_filename)
-            object_acl.put(ACL="public-read")
-
-            # removes image from server
-            os.remove(img_temploc)
-
-
-        except Exception as e:
-            print(f"Error when uploading image: {e}")
+        return {
+            "id": self.id,
+            "url": self.serialize(),
+            "status": self.status,
+            "width": self.width,
+            "height": self.height,
+            "variants": self.serialize_variants()
+        }
 
+    def prepare(self, content_type):
+        """
+        Checks the filetype of an image and picks its file name, leaving
+        the asset pending
+        """
+        ext = image_extension(content_type)
 
+        #generate random strong name for file
+        self.salt = "".join(
+            random.SystemRandom().choice(
+                string.ascii_uppercase+ string.digits
+            )
+            for _ in range(16)
+        )
+        self.base_url = get_storage().base_url
+        self.extension = ext
+        self.width = 0
+        self.height = 0
+        self.status = ASSET_PENDING
+        self.processing_started = int(time.time())
+
+    def process(self, img_file):
+        """
+        Records the dimensions of a prepared image, given as a binary file
+        object, and uploads it and its resized variants to storage, marking
+        it ready
+        """
+        img = Image.open(img_file)
+        img.load()
+        self.width = img.width
+        self.height = img.height
+
+        filename = f"{self.salt}.{self.extension}"
+        img_file.seek(0)
+        get_storage().put_file(filename, img_file, guess_type(filename)[0])
+        self.create_variants(img)
+        self.status = ASSET_READY
+
+    def create_variants(self, img):
+        """
+        Uploads a re-encoded copy of img for each of IMAGE_VARIANTS, never
+        upscaling; re-encoding drops EXIF and other metadata, so the
+        orientation tag is applied to the pixels first
+        """
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA" if "transparency" in img.info else "RGB")
+        for name, size in IMAGE_VARIANTS.items():
+            variant = img.copy()
+            variant.thumbnail((size, size), Image.LANCZOS)
+            buffer = BytesIO()
+            variant.save(buffer, VARIANT_FORMAT, quality=VARIANT_QUALITY)
+            get_storage().put(self.variant_filename(name), buffer.getvalue(), f"image/{VARIANT_FORMAT}")
+        self.variants = ",".join(IMAGE_VARIANTS)
@@ -0,0 +1,80 @@
+"""
+Google ID token verification
+
+Verifies the ID tokens clients get from Google Sign-In against Google's
+public signing certificates. The certificates are fetched over a pooled
+HTTP session and cached for as long as Google's Cache-Control allows, so
+logins normally verify without any outbound request. Set GOOGLE_CERTS_URL
+to verify against a local stand-in for the certificate endpoint.
+"""
+
+import os
+import re
+import threading
+import time
+
+import requests
+from google.auth import jwt
+
+GOOGLE_CERTS_URL = os.environ.get("GOOGLE_CERTS_URL", "https://www.googleapis.com/oauth2/v1/certs")
+GOOGLE_ISSUERS = ("accounts.google.com", "https://accounts.google.com")
+# used when the certificate response carries no max-age
+DEFAULT_CERTS_TTL = 60 * 60
+# a token signed with an unknown key refetches the certificates (Google
+# rotated its keys) at most this often
+MIN_CERTS_REFRESH = 60
+CERTS_TIMEOUT = 5
+
+
+class CertificateCache:
+    """
+    Google's signing certificates, refetched once their max-age runs out
+    """
+
+    def __init__(self, url=GOOGLE_CERTS_URL):
+        """
+        Initializes an empty cache for the certificates served at url
+        """
+        self.url = url
+        self.session = requests.Session()
+        self._certs = None
+        self._fetched = 0
+        self._expires = 0
+        self._lock = threading.Lock()
+
+    def get(self, refresh=False):
+        """
+        Returns the certificates as a dict of key id to PEM certificate
+
+        With refresh, fetches them again unless they were just fetched
+        """
+        with self._lock:
+            now = time.time()
+            stale = refresh and now - self._fetched >= MIN_CERTS_REFRESH
+            if self._certs is None or now >= self._expires or stale:
+                response = self.session.get(self.url, timeout=CERTS_TIMEOUT)
+                response.raise_for_status()
+                max_age = re.search(r"max-age=(\d+)", response.headers.get("Cache-Control", ""))
+                self._certs = response.json()
+                self._fetched = now
+                self._expires = now + (int(max_age.group(1)) if max_age else DEFAULT_CERTS_TTL)
+            return self._certs
+
+
+certificates = CertificateCache()
+
+
+def verify_token(token, audience):
+    """
+    Verifies a Google ID token issued for audience (our client id)
+
+    Returns the token's claims; raises ValueError if it is invalid
+    """
+    try:
+        claims = jwt.decode(token, certs=certificates.get(), audience=audience)
+    except ValueError:
+        # the token may be signed with a key newer than the cached ones
+        claims = jwt.decode(token, certs=certificates.get(refresh=True), audience=audience)
+    if claims.get("iss") not in GOOGLE_ISSUERS:
+        raise ValueError(f"Wrong issuer: {claims.get('iss')}")
+    return claims
@@ -0,0 +1,165 @@
+"""
+Background image processing
+
+create_event and the upload endpoint store a pending Asset and hand the
+image to a worker pool, which resizes and uploads it so request latency does
+not depend on storage.
+Set IMAGE_WORKERS=0 to process images inline in the request instead.
+"""
+
+import hashlib
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from db import db
+from db import Asset
+from db import ASSET_FAILED
+
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", 4))
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# uploads up to this size stay in memory while spooled, larger ones go to disk
+SPOOL_MAX_MEMORY = 1024 * 1024
+
+_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="images") if IMAGE_WORKERS > 0 else None
+
+
+class UploadTooLarge(ValueError):
+    """
+    Raised when an upload exceeds its size limit
+    """
+
+
+class LimitedUpload:
+    """
+    Wraps a request body of unknown length (chunked), raising
+    RequestEntityTooLarge as soon as more than limit bytes have been read,
+    so Werkzeug's form parser cannot buffer an oversized upload
+
+    RequestEntityTooLarge rather than UploadTooLarge, since the form parser
+    swallows ValueErrors
+    """
+
+    def __init__(self, stream, limit):
+        """
+        Initializes a wrapper around the WSGI input stream
+        """
+        self.stream = stream
+        self.limit = limit
+        self.size = 0
+
+    def _count(self, data):
+        self.size += len(data)
+        if self.size > self.limit:
+            raise RequestEntityTooLarge(f"Upload is larger than {self.limit} bytes")
+        return data
+
+    def read(self, size=-1):
+        """
+        Reads like the wrapped stream, counting the bytes read
+        """
+        return self._count(self.stream.read(size))
+
+    def readline(self, size=-1):
+        """
+        Reads a line like the wrapped stream, counting the bytes read
+        """
+        return self._count(self.stream.readline(size))
+
+    def exhaust(self):
+        """
+        Called by Werkzeug after parsing; leaves the rest of the body
+        unread rather than draining a body that may never end
+        """
+
+
+def hash_upload(img_file):
+    """
+    Hashes an already spooled upload in chunks
+
+    Returns (digest, size) with img_file rewound to the start
+    """
+    digest = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = img_file.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+        digest.update(chunk)
+    img_file.seek(0)
+    return digest.hexdigest(), size
+
+
+def spool_upload(stream, limit):
+    """
+    Reads an upload stream in chunks into a spooled temporary file, hashing
+    it on the way
+
+    Returns (file, digest, size) with file rewound to the start; raises
+    UploadTooLarge as soon as more than limit bytes have been read
+    """
+    img_file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+    digest = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = stream.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > limit:
+            img_file.close()
+            raise UploadTooLarge(f"Image is larger than {limit} bytes")
+        digest.update(chunk)
+        img_file.write(chunk)
+    img_file.seek(0)
+    return img_file, digest.hexdigest(), size
+
+
+def process_in_background(asset_id, img_file, on_done=None):
+    """
+    Processes the image of a committed pending asset on the worker pool,
+    given as a binary file object which is closed afterwards
+
+    on_done, if given, is called with the asset once it is ready or failed
+    """
+    if _executor is None:
+        process_asset(asset_id, img_file, on_done)
+    else:
+        app = current_app._get_current_object()
+        _executor.submit(process_asset_in_context, app, asset_id, img_file, on_done)
+
+
+def process_asset_in_context(app, asset_id, img_file, on_done=None):
+    """
+    Runs process_asset inside an application context of app, for workers
+    """
+    with app.app_context():
+        process_asset(asset_id, img_file, on_done)
+
+
+def process_asset(asset_id, img_file, on_done=None):
+    """
+    Resizes and uploads the image of a pending asset and records the result
+    """
+    asset = Asset.query.filter_by(id=asset_id).first()
+    if asset is None:
+        img_file.close()
+        return
+    # counts the processing timeout from now rather than from queueing
+    asset.processing_started = int(time.time())
+    db.session.commit()
+    try:
+        asset.process(img_file)
+    except Exception as e:
+        asset.status = ASSET_FAILED
+        print(f"Error when processing image {asset_id}: {e}")
+    finally:
+        img_file.close()
+    db.session.commit()
+    if on_done is not None:
+        on_done(asset)
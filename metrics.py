@@ -0,0 +1,210 @@
+"""
+Request and SQL instrumentation
+
+Counts the SQL statements each request runs and the time spent in them,
+reports both with the handler time in a Server-Timing header, and keeps
+per-route histograms served in the Prometheus text format by /metrics.
+Set SLOW_QUERY_MS to log every statement slower than that many
+milliseconds, and SQLALCHEMY_ECHO=1 to log every statement as before.
+"""
+
+import os
+import threading
+import time
+
+from flask import g, has_request_context, request
+from sqlalchemy import event as sa_event
+from sqlalchemy.engine import Engine
+
+SLOW_QUERY_MS = float(os.environ["SLOW_QUERY_MS"]) if os.environ.get("SLOW_QUERY_MS") else None
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# upper bounds of the statements per request histogram buckets
+STATEMENT_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+
+
+def echo_enabled():
+    """
+    Whether every SQL statement should be logged (SQLALCHEMY_ECHO=1)
+    """
+    return os.environ.get("SQLALCHEMY_ECHO", "0").lower() in ("1", "true")
+
+
+class Histogram:
+    """
+    Cumulative histogram over fixed bucket upper bounds
+    """
+
+    def __init__(self, buckets):
+        """
+        Initializes an empty histogram
+        """
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        """
+        Records one value
+        """
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+def labels(**values):
+    """
+    Formats Prometheus labels, escaping their values
+    """
+    escaped = []
+    for name, value in values.items():
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        escaped.append(f'{name}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+
+class Metrics:
+    """
+    Per-route request and SQL metrics for the whole process
+    """
+
+    def __init__(self):
+        """
+        Initializes empty metrics
+        """
+        self.latency = {}
+        self.statements = {}
+        self.requests = {}
+        self.sql_statements = {}
+        self.sql_seconds = {}
+        self.slow_queries = 0
+        self._lock = threading.Lock()
+
+    def observe(self, method, route, status, seconds, statements, sql_seconds):
+        """
+        Records one finished request
+        """
+        key = (method, route)
+        with self._lock:
+            self.latency.setdefault(key, Histogram(LATENCY_BUCKETS)).observe(seconds)
+            self.statements.setdefault(key, Histogram(STATEMENT_BUCKETS)).observe(statements)
+            self.requests[key + (status,)] = self.requests.get(key + (status,), 0) + 1
+            self.sql_statements[key] = self.sql_statements.get(key, 0) + statements
+            self.sql_seconds[key] = self.sql_seconds.get(key, 0) + sql_seconds
+
+    def observe_slow_query(self):
+        """
+        Records one statement slower than SLOW_QUERY_MS
+        """
+        with self._lock:
+            self.slow_queries += 1
+
+    def render(self):
+        """
+        Returns the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            for name, doc, histograms in (
+                ("http_request_duration_seconds", "Request handling time", self.latency),
+                ("db_statements_per_request", "SQL statements run per request", self.statements),
+            ):
+                lines += [f"# HELP {name} {doc}", f"# TYPE {name} histogram"]
+                for (method, route), histogram in sorted(histograms.items()):
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f"{name}_bucket{labels(method=method, route=route, le=bound)} {count}")
+                    lines.append(f"{name}_bucket{labels(method=method, route=route, le='+Inf')} {histogram.count}")
+                    lines.append(f"{name}_sum{labels(method=method, route=route)} {histogram.sum}")
+                    lines.append(f"{name}_count{labels(method=method, route=route)} {histogram.count}")
+
+            lines += ["# HELP http_requests_total Requests handled", "# TYPE http_requests_total counter"]
+            for (method, route, status), count in sorted(self.requests.items()):
+                lines.append(f"http_requests_total{labels(method=method, route=route, status=status)} {count}")
+            for name, doc, counters in (
+                ("db_statements_total", "SQL statements run", self.sql_statements),
+                ("db_statement_seconds_total", "Time spent running SQL statements", self.sql_seconds),
+            ):
+                lines += [f"# HELP {name} {doc}", f"# TYPE {name} counter"]
+                for (method, route), value in sorted(counters.items()):
+                    lines.append(f"{name}{labels(method=method, route=route)} {value}")
+            lines += [
+                "# HELP db_slow_queries_total SQL statements slower than SLOW_QUERY_MS",
+                "# TYPE db_slow_queries_total counter",
+                f"db_slow_queries_total {self.slow_queries}",
+            ]
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+_sql_logger = None
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """
+    Notes when a statement started
+    """
+    context._metrics_start = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """
+    Adds a finished statement to the current request's totals and logs it
+    if it was slow
+    """
+    elapsed = time.perf_counter() - context._metrics_start
+    if has_request_context() and "sql_statements" in g:
+        g.sql_statements += 1
+        g.sql_seconds += elapsed
+    if SLOW_QUERY_MS is not None and elapsed * 1000 >= SLOW_QUERY_MS:
+        metrics.observe_slow_query()
+        if _sql_logger is not None:
+            _sql_logger.warning("Slow query (%.1f ms): %s %r", elapsed * 1000, statement, parameters)
+
+
+def instrument_sql(logger):
+    """
+    Times every statement run by any engine in the process, logging slow
+    ones to logger
+    """
+    global _sql_logger
+    if _sql_logger is None:
+        sa_event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+        sa_event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+    _sql_logger = logger
+
+
+def start_request():
+    """
+    Resets the SQL totals and starts the clock for the current request
+    """
+    g.request_start = time.perf_counter()
+    g.sql_statements = 0
+    g.sql_seconds = 0
+
+
+def finish_request(response):
+    """
+    Records the current request and adds its Server-Timing header
+    """
+    if "request_start" not in g:
+        return response
+    seconds = time.perf_counter() - g.request_start
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    metrics.observe(request.method, route, response.status_code, seconds, g.sql_statements, g.sql_seconds)
+    response.headers.add(
+        "Server-Timing",
+        f'db;dur={g.sql_seconds * 1000:.2f};desc="{g.sql_statements} queries", app;dur={seconds * 1000:.2f}'
+    )
+    return response
+
+
+def init_app(app):
+    """
+    Instruments every request to app and the SQL statements they run
+    """
+    instrument_sql(app.logger)
+    app.before_request(start_request)
+    app.after_request(finish_request)
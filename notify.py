@@ -1,56 +1,379 @@
 # code to send notifications/reminders
+#
+# runs as a long-lived scheduler: every REMINDER_INTERVAL seconds it texts
+# users about saved events starting within REMINDER_LEAD seconds and deletes
+# events that have already happened. Every RECOMMEND_REBUILD_INTERVAL seconds
+# it also rebuilds the recommendation similarity lists, and every pass
+# refreshes the trending events ranking. `python notify.py
+# --once` runs a single pass, e.g. from cron, and `python notify.py --purge`
+# only deletes past events. Set REMINDER_TRANSPORT=fake to log messages
+# instead of sending them through Twilio.
 from db import db
+from db import upgrade_schema
+from db import database_path
 from db import Event
-from db import User 
-from db import Bucket
-from db import Asset
+from db import Category
+from db import User
+from db import ReminderSent
+from db import EventSimilarity
+from db import EventSaveBucket
+from db import TrendingEvent
+from db import CacheInvalidation, CACHE_INVALIDATION_RETENTION
+from db import category_association_table
+from db import created_events_association_table
+from db import saved_events_association_table
+
+import metrics
+import recommend
+import trending
 
 from flask import Flask
 
 # Download the helper library from https://www.twilio.com/docs/python/install
 import os
+import random
+import socket
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
 from twilio.rest import Client
 
 import time
-from datetime import datetime, timedelta
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("SECRET_KEY") or os.urandom(24)
-db_filename = "bukethaca.db"
+db_filename = database_path()
 
-# setup config 
+# setup config
 app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///%s" % db_filename
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["SQLALCHEMY_ECHO"] = True
-
-# initialize app
-db.init_app(app)
-with app.app_context():
-    events = Event.query.all()
-
-    for event in events:
-        event_time = datetime.fromtimestamp(int(event.date))
-
-        # checks if date already passed
-        if event_time < datetime.now():
-            db.session.delete(event)
-            db.session.commit()
-        
-        # checks if date and time are equal
-        tomorrow = datetime.now() + timedelta(1)
-        #comment this if statement out when testing
-        if event_time - tomorrow < timedelta(seconds=30):
-            account_sid = os.environ['TWILIO_ACCOUNT_SID']
-            auth_token = os.environ['TWILIO_AUTH_TOKEN']
-            client = Client(account_sid, auth_token)
-            reminded = event.users_saved #get the users that need to be reminded about that event
-            for u in reminded:
-                # Find your Account SID and Auth Token at twilio.com/console
-                # and set the environment variables. See http://twil.io/secure
-                if u.number is not None:
-                    message = client.messages.create(
-                        body='Hello there! You have an upcoming event! Please visit the Buckethaca app for more info :)',
-                        from_='+13254408918',
-                        media_url=['https://demo.twilio.com/owl.png'],
-                        to= u.number 
-                    )
\ No newline at end of file
+app.config["SQLALCHEMY_ECHO"] = metrics.echo_enabled()
+
+REMINDER_INTERVAL = int(os.environ.get("REMINDER_INTERVAL", 60))
+REMINDER_LEAD = int(os.environ.get("REMINDER_LEAD", 24 * 60 * 60))
+REMINDER_BODY = "Hello there! You have an upcoming event! Please visit the Buckethaca app for more info :)"
+REMINDER_MEDIA_URL = "https://demo.twilio.com/owl.png"
+TWILIO_FROM_NUMBER = os.environ.get("TWILIO_FROM_NUMBER", "+13254408918")
+# fan-out: messages are sent from REMINDER_WORKERS threads, at most
+# REMINDER_RATE per second, retrying transient failures with backoff
+REMINDER_WORKERS = int(os.environ.get("REMINDER_WORKERS", 8))
+REMINDER_RATE = float(os.environ.get("REMINDER_RATE", 1))
+REMINDER_RETRIES = int(os.environ.get("REMINDER_RETRIES", 3))
+REMINDER_BACKOFF = float(os.environ.get("REMINDER_BACKOFF", 1))
+PURGE_BATCH_SIZE = int(os.environ.get("PURGE_BATCH_SIZE", 500))
+# seconds between full rebuilds of the recommendation similarity lists
+RECOMMEND_REBUILD_INTERVAL = int(os.environ.get("RECOMMEND_REBUILD_INTERVAL", 6 * 60 * 60))
+
+# rows referencing an event, as (table, event id column), deleted with it
+EVENT_REFERENCES = [
+    (category_association_table, category_association_table.c.event_id),
+    (saved_events_association_table, saved_events_association_table.c.users_saved_id),
+    (created_events_association_table, created_events_association_table.c.users_created_id),
+    (ReminderSent.__table__, ReminderSent.__table__.c.event_id),
+    (EventSimilarity.__table__, EventSimilarity.__table__.c.event_id),
+    (EventSimilarity.__table__, EventSimilarity.__table__.c.similar_id),
+    (EventSaveBucket.__table__, EventSaveBucket.__table__.c.event_id),
+    (TrendingEvent.__table__, TrendingEvent.__table__.c.event_id),
+]
+
+
+class TwilioTransport:
+    """
+    Sends text messages through Twilio with one client for the whole process
+    """
+
+    def __init__(self):
+        """
+        Initializes the Twilio client from the environment
+        """
+        # Find your Account SID and Auth Token at twilio.com/console
+        # and set the environment variables. See http://twil.io/secure
+        self.client = Client(os.environ["TWILIO_ACCOUNT_SID"], os.environ["TWILIO_AUTH_TOKEN"])
+
+    def send(self, to, body):
+        """
+        Texts body to the number to
+        """
+        self.client.messages.create(
+            body=body,
+            from_=TWILIO_FROM_NUMBER,
+            media_url=[REMINDER_MEDIA_URL],
+            to=to
+        )
+
+
+class FakeTransport:
+    """
+    Records text messages instead of sending them, optionally waiting
+    latency seconds per message and failing a fraction failure_rate of
+    them to stand in for the provider
+    """
+
+    def __init__(self, latency=0, failure_rate=0):
+        """
+        Initializes a transport with no messages sent
+        """
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def send(self, to, body):
+        """
+        Records body as texted to the number to
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        if random.random() < self.failure_rate:
+            raise ConnectionError("Simulated transport failure")
+        with self._lock:
+            self.sent.append((to, body))
+        print(f"Reminder to {to}: {body}")
+
+
+def get_transport():
+    """
+    Returns the transport selected by REMINDER_TRANSPORT ("twilio" or "fake")
+    """
+    if os.environ.get("REMINDER_TRANSPORT", "twilio") == "fake":
+        return FakeTransport(
+            float(os.environ.get("FAKE_TRANSPORT_LATENCY", 0)),
+            float(os.environ.get("FAKE_TRANSPORT_FAILURE_RATE", 0))
+        )
+    return TwilioTransport()
+
+
+class RateLimiter:
+    """
+    Spaces out calls from any number of threads to at most rate per second
+    """
+
+    def __init__(self, rate):
+        """
+        Initializes a limiter whose first call goes through immediately
+        """
+        self.interval = 1 / rate if rate > 0 else 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until the caller may make its call
+        """
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def is_transient(error):
+    """
+    Whether a failed send is worth retrying: rate limiting, provider
+    errors and network errors are; anything else (e.g. a bad number) is not
+    """
+    status = getattr(error, "status", None)
+    if status is None and isinstance(error, requests.RequestException) and error.response is not None:
+        status = error.response.status_code
+    if status is not None:
+        return status == 429 or status >= 500
+    # Twilio's HTTP client raises requests' own connection and timeout
+    # errors, which are not subclasses of the built-in ones
+    return isinstance(error, (ConnectionError, TimeoutError, socket.timeout, requests.RequestException))
+
+
+def send_with_retry(transport, limiter, to, body):
+    """
+    Sends one message within the rate limit, retrying transient failures
+    with exponential backoff and jitter
+
+    Returns the number of retries needed; raises the last error if the
+    message could not be sent
+    """
+    for attempt in range(REMINDER_RETRIES + 1):
+        limiter.acquire()
+        try:
+            transport.send(to, body)
+            return attempt
+        except Exception as e:
+            if attempt == REMINDER_RETRIES or not is_transient(e):
+                raise
+            time.sleep(REMINDER_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5))
+
+
+def due_reminders(now):
+    """
+    Returns (user_id, number, event_id) for every user with a phone number
+    who saved an event starting in the next REMINDER_LEAD seconds and has
+    not been reminded about it yet
+
+    Starts from a range scan of the events date index
+    """
+    return db.session.query(User.id, User.number, Event.id) \
+        .join(saved_events_association_table, saved_events_association_table.c.users_saved_id == Event.id) \
+        .join(User, User.id == saved_events_association_table.c.saved_event_id) \
+        .outerjoin(ReminderSent, (ReminderSent.user_id == User.id) & (ReminderSent.event_id == Event.id)) \
+        .filter(Event.date >= now, Event.date <= now + REMINDER_LEAD) \
+        .filter(User.number.isnot(None), ReminderSent.user_id.is_(None)) \
+        .all()
+
+
+def claim_reminders(reminders, now):
+    """
+    Records reminders as sent before sending them, in one transaction
+
+    Returns the reminders claimed; ones already recorded, e.g. by another
+    scheduler process, are left out
+    """
+    claimed = []
+    for user_id, number, event_id in reminders:
+        result = db.session.execute(
+            ReminderSent.__table__.insert().prefix_with("OR IGNORE").values(user_id=user_id, event_id=event_id, sent_at=now)
+        )
+        if result.rowcount == 1:
+            claimed.append((user_id, number, event_id))
+    db.session.commit()
+    return claimed
+
+
+def release_reminders(reminders):
+    """
+    Forgets claimed reminders whose messages failed transiently, so they
+    are retried on a later pass
+    """
+    for user_id, number, event_id in reminders:
+        ReminderSent.query.filter_by(user_id=user_id, event_id=event_id).delete()
+    db.session.commit()
+
+
+def send_reminders(transport, now=None):
+    """
+    Texts every due reminder once, fanning out over REMINDER_WORKERS
+    threads within REMINDER_RATE messages per second
+
+    Returns delivery stats for the batch
+    """
+    now = int(time.time()) if now is None else now
+    start = time.monotonic()
+    due = due_reminders(now)
+    claimed = claim_reminders(due, now)
+    limiter = RateLimiter(REMINDER_RATE)
+
+    def send(reminder):
+        user_id, number, event_id = reminder
+        try:
+            return send_with_retry(transport, limiter, str(number), REMINDER_BODY), None
+        except Exception as e:
+            print(f"Error when reminding user {user_id} about event {event_id}: {e}")
+            return 0, e
+
+    # permanent failures (e.g. an invalid number) stay claimed so they are
+    # not retried every pass; transient ones that ran out of retries are
+    # released
+    failed = []
+    rejected = 0
+    retries = 0
+    if claimed:
+        with ThreadPoolExecutor(max_workers=REMINDER_WORKERS) as pool:
+            for reminder, (attempts, error) in zip(claimed, pool.map(send, claimed)):
+                retries += attempts
+                if error is None:
+                    continue
+                if is_transient(error):
+                    failed.append(reminder)
+                else:
+                    rejected += 1
+    release_reminders(failed)
+    return {
+        "due": len(due),
+        "sent": len(claimed) - len(failed) - rejected,
+        "failed": len(failed),
+        "rejected": rejected,
+        "retries": retries,
+        "seconds": round(time.monotonic() - start, 3)
+    }
+
+
+def purge_expired_events(cutoff=None, batch_size=PURGE_BATCH_SIZE):
+    """
+    Deletes events dated before cutoff (default now) along with their
+    category, saved, created and reminder rows, uncounting them from their
+    categories and invalidating them in the app's response cache
+
+    Works through the events date index in batches of batch_size ids, each
+    batch a handful of set-based DELETEs in one short transaction. Returns
+    the rows deleted per table and the time taken.
+    """
+    cutoff = int(time.time()) if cutoff is None else cutoff
+    start = time.monotonic()
+    deleted = {table.name: 0 for table, column in EVENT_REFERENCES}
+    deleted["events"] = 0
+    batches = 0
+    while True:
+        ids = [row[0] for row in db.session.query(Event.id)
+               .filter(Event.date < cutoff).order_by(Event.date).limit(batch_size)]
+        if not ids:
+            break
+        category_ids = Category.remove_events(ids)
+        CacheInvalidation.publish(
+            ["events", "facets"] + [f"event:{id}" for id in ids] + [f"category:{id}" for id in category_ids]
+        )
+        for table, column in EVENT_REFERENCES:
+            deleted[table.name] += db.session.execute(table.delete().where(column.in_(ids))).rowcount
+        deleted["events"] += db.session.execute(Event.__table__.delete().where(Event.id.in_(ids))).rowcount
+        db.session.commit()
+        batches += 1
+    return {
+        "deleted": deleted,
+        "batches": batches,
+        "seconds": round(time.monotonic() - start, 3)
+    }
+
+
+def run_once(transport, rebuild=False):
+    """
+    Runs one scheduler pass, rebuilding the recommendation similarity
+    lists too if rebuild
+    """
+    print(f"Purge: {purge_expired_events()}")
+    print(f"Reminders: {send_reminders(transport)}")
+    print(f"Trending: {trending.refresh_trending()}")
+    invalidated = ["trending"]
+    if rebuild:
+        print(f"Recommendations: {recommend.rebuild_similarities()}")
+        invalidated.append("recommendations")
+    CacheInvalidation.publish(invalidated)
+    CacheInvalidation.prune(int(time.time()) - CACHE_INVALIDATION_RETENTION)
+    db.session.commit()
+
+
+def main():
+    """
+    Runs the scheduler until interrupted, or a single pass with --once
+    """
+    db.init_app(app)
+    metrics.instrument_sql(app.logger)
+    with app.app_context():
+        db.create_all()
+        upgrade_schema()
+    if "--purge" in sys.argv:
+        with app.app_context():
+            print(f"Purge: {purge_expired_events()}")
+        return
+    transport = get_transport()
+    last_rebuild = None
+    while True:
+        rebuild = last_rebuild is None or time.monotonic() - last_rebuild >= RECOMMEND_REBUILD_INTERVAL
+        with app.app_context():
+            run_once(transport, rebuild)
+        if rebuild:
+            last_rebuild = time.monotonic()
+        if "--once" in sys.argv:
+            break
+        time.sleep(REMINDER_INTERVAL)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Pagination helpers
+
+Keyset (cursor) pagination over (Event.date, Event.id) so that every page is
+a single index range scan no matter how deep the client scrolls
+"""
+
+import base64
+
+from sqlalchemy import and_, or_
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+
+
+class PaginationError(ValueError):
+    """
+    Raised when a client passes a malformed limit or cursor
+    """
+
+
+def parse_limit(value, default=DEFAULT_LIMIT, maximum=MAX_LIMIT):
+    """
+    Parses the limit query parameter, clamping it to [1, maximum]
+    """
+    if value is None:
+        return default
+    try:
+        limit = int(value)
+    except ValueError:
+        raise PaginationError("limit must be an integer")
+    if limit < 1:
+        raise PaginationError("limit must be positive")
+    return min(limit, maximum)
+
+
+def encode_cursor(*values):
+    """
+    Encodes the sort key of the last row on a page into an opaque cursor
+    """
+    raw = ":".join(str(v) for v in values)
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor, size=2):
+    """
+    Decodes a cursor produced by encode_cursor back into a tuple of ints
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = tuple(int(v) for v in base64.urlsafe_b64decode(padded).decode().split(":"))
+    except (ValueError, UnicodeDecodeError):
+        raise PaginationError("Invalid cursor")
+    if len(values) != size:
+        raise PaginationError("Invalid cursor")
+    return values
+
+
+def paginate_by_date(query, model, cursor=None, limit=DEFAULT_LIMIT):
+    """
+    Returns (rows, next_cursor) for one page of query ordered by (date, id)
+
+    next_cursor is None once the last page has been reached
+    """
+    if cursor is not None:
+        date, id = decode_cursor(cursor)
+        query = query.filter(or_(
+            model.date > date,
+            and_(model.date == date, model.id > id)
+        ))
+    rows = query.order_by(model.date, model.id).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].date, rows[-1].id)
+    return rows, next_cursor
@@ -0,0 +1,162 @@
+"""
+"Saved together" event recommendations
+
+Treats association_saved_events as a sparse user x event matrix X. The
+co-bookmark count of two events, how many users saved both, is an entry of
+X^T X. rebuild_similarities computes it with SciPy and keeps the
+SIMILAR_EVENTS_K most co-saved events for every event in event_similarities.
+The counts are kept current in between with one statement per save or
+unsave, so rebuilds only need to run on a schedule (see notify.py) or by
+hand with `python recommend.py`. Recommendations for a user sum the counts
+of the events similar to the ones they saved, reading only those rows.
+"""
+
+import os
+import time
+
+import numpy as np
+from scipy import sparse
+from sqlalchemy import bindparam, func, select, text
+
+from db import db
+from db import Event
+from db import EventSimilarity
+from db import saved_events_association_table
+
+SIMILAR_EVENTS_K = int(os.environ.get("SIMILAR_EVENTS_K", 50))
+REBUILD_BATCH_SIZE = 1000
+
+# ordered pairs (event, other event) saved by :user_id, at least one of
+# them in :event_ids
+SAVED_PAIRS = """
+    SELECT a.users_saved_id, b.users_saved_id
+    FROM association_saved_events AS a
+    JOIN association_saved_events AS b
+        ON b.saved_event_id = a.saved_event_id AND b.users_saved_id != a.users_saved_id
+    WHERE a.saved_event_id = :user_id
+        AND (a.users_saved_id IN :event_ids OR b.users_saved_id IN :event_ids)
+"""
+
+COUNT_SAVES = text(f"""
+    INSERT INTO event_similarities (event_id, similar_id, co_count)
+    SELECT pairs.*, 1 FROM ({SAVED_PAIRS}) AS pairs WHERE true
+    ON CONFLICT (event_id, similar_id) DO UPDATE SET co_count = co_count + 1
+""").bindparams(bindparam("event_ids", expanding=True))
+
+UNCOUNT_SAVES = text(f"""
+    UPDATE event_similarities SET co_count = co_count - 1
+    WHERE (event_id, similar_id) IN ({SAVED_PAIRS})
+""").bindparams(bindparam("event_ids", expanding=True))
+
+DELETE_UNSHARED = text("""
+    DELETE FROM event_similarities
+    WHERE co_count <= 0 AND (event_id IN :event_ids OR similar_id IN :event_ids)
+""").bindparams(bindparam("event_ids", expanding=True))
+
+
+def record_saves(user_id, event_ids):
+    """
+    Counts user_id saving event_ids together with everything else they
+    saved; call after the saved rows are inserted
+    """
+    if event_ids:
+        db.session.execute(COUNT_SAVES, {"user_id": user_id, "event_ids": list(event_ids)})
+
+
+def forget_saves(user_id, event_ids):
+    """
+    Uncounts user_id saving event_ids; call before the saved rows are
+    deleted
+    """
+    if event_ids:
+        params = {"user_id": user_id, "event_ids": list(event_ids)}
+        db.session.execute(UNCOUNT_SAVES, params)
+        db.session.execute(DELETE_UNSHARED, params)
+
+
+def forget_events(event_ids):
+    """
+    Deletes every similarity row of event_ids, e.g. before deleting them
+
+    Returns the number of rows deleted
+    """
+    table = EventSimilarity.__table__
+    return db.session.execute(table.delete().where(
+        table.c.event_id.in_(event_ids) | table.c.similar_id.in_(event_ids)
+    )).rowcount
+
+
+def top_k_pairs(rows, top_k):
+    """
+    Returns (event ids, similar ids, co-counts) arrays of the top_k most
+    co-saved events for every event, from (user id, event id) saved rows
+    """
+    saved = np.array(rows, dtype=np.int64).reshape(-1, 2)
+    users, user_index = np.unique(saved[:, 0], return_inverse=True)
+    events, event_index = np.unique(saved[:, 1], return_inverse=True)
+    X = sparse.csr_matrix(
+        (np.ones(len(saved), dtype=np.int32), (user_index, event_index)),
+        shape=(len(users), len(events))
+    )
+    counts = (X.T @ X).tocoo()
+    off_diagonal = counts.row != counts.col
+    row, col, data = counts.row[off_diagonal], counts.col[off_diagonal], counts.data[off_diagonal]
+
+    # sort by event, then count descending, and keep each event's first top_k
+    order = np.lexsort((col, -data, row))
+    row, col, data = row[order], col[order], data[order]
+    rank = np.arange(len(row)) - np.searchsorted(row, row)
+    keep = rank < top_k
+    return events[row[keep]], events[col[keep]], data[keep]
+
+
+def rebuild_similarities(top_k=SIMILAR_EVENTS_K):
+    """
+    Recomputes every event's top_k similar events from scratch, replacing
+    event_similarities in one transaction
+
+    Returns the number of events and pairs kept and the time taken
+    """
+    start = time.monotonic()
+    table = EventSimilarity.__table__
+    rows = db.session.query(
+        saved_events_association_table.c.saved_event_id,
+        saved_events_association_table.c.users_saved_id
+    ).all()
+    event_ids, similar_ids, co_counts = top_k_pairs(rows, top_k)
+    db.session.execute(table.delete())
+    for i in range(0, len(event_ids), REBUILD_BATCH_SIZE):
+        db.session.execute(table.insert(), [
+            {"event_id": int(e), "similar_id": int(s), "co_count": int(c)}
+            for e, s, c in zip(*(a[i:i + REBUILD_BATCH_SIZE] for a in (event_ids, similar_ids, co_counts)))
+        ])
+    db.session.commit()
+    return {
+        "events": len(np.unique(event_ids)),
+        "pairs": len(event_ids),
+        "seconds": round(time.monotonic() - start, 3)
+    }
+
+
+def recommended_event_ids(user_id, limit, now=None):
+    """
+    Returns [(event id, score)] of upcoming events the user has not saved,
+    scored by how often they were saved together with the user's events
+    """
+    now = int(time.time()) if now is None else now
+    saved = select([saved_events_association_table.c.users_saved_id]) \
+        .where(saved_events_association_table.c.saved_event_id == user_id)
+    score = func.sum(EventSimilarity.co_count).label("score")
+    return db.session.query(EventSimilarity.similar_id, score) \
+        .join(Event, Event.id == EventSimilarity.similar_id) \
+        .filter(EventSimilarity.event_id.in_(saved), EventSimilarity.similar_id.notin_(saved)) \
+        .filter(Event.date >= now) \
+        .group_by(EventSimilarity.similar_id) \
+        .order_by(score.desc(), EventSimilarity.similar_id) \
+        .limit(limit).all()
+
+
+if __name__ == "__main__":
+    from app import app
+    with app.app_context():
+        print(f"Rebuilt similarities: {rebuild_similarities()}")
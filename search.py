@@ -0,0 +1,118 @@
+"""
+Full-text search over events
+
+Backed by an SQLite FTS5 external-content table over the events table, kept
+in sync by triggers so every insert, update and delete of an event (through
+the ORM or raw SQL) updates the index in the same transaction
+"""
+
+import re
+
+from sqlalchemy import false, literal_column, select, table
+from sqlalchemy.exc import OperationalError
+
+from db import db
+from db import Event
+
+SEARCH_COLUMNS = "title, description, location, host_name"
+
+SEARCH_TRIGGERS = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS events_fts_insert AFTER INSERT ON events BEGIN
+        INSERT INTO events_fts (rowid, {SEARCH_COLUMNS})
+        VALUES (new.id, new.title, new.description, new.location, new.host_name);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS events_fts_delete AFTER DELETE ON events BEGIN
+        INSERT INTO events_fts (events_fts, rowid, {SEARCH_COLUMNS})
+        VALUES ('delete', old.id, old.title, old.description, old.location, old.host_name);
+    END
+    """,
+    # only text changes reindex; counter updates (e.g. save_count) do not
+    "DROP TRIGGER IF EXISTS events_fts_update",
+    f"""
+    CREATE TRIGGER IF NOT EXISTS events_fts_update_text
+    AFTER UPDATE OF {SEARCH_COLUMNS} ON events BEGIN
+        INSERT INTO events_fts (events_fts, rowid, {SEARCH_COLUMNS})
+        VALUES ('delete', old.id, old.title, old.description, old.location, old.host_name);
+        INSERT INTO events_fts (rowid, {SEARCH_COLUMNS})
+        VALUES (new.id, new.title, new.description, new.location, new.host_name);
+    END
+    """,
+]
+
+# set by create_search_index; False when SQLite was built without FTS5
+fts_enabled = False
+
+
+def create_search_index():
+    """
+    Creates the events_fts table and its triggers if they do not exist yet,
+    indexing any events already in the database
+    """
+    global fts_enabled
+    exists = db.session.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'events_fts'"
+    ).first() is not None
+    try:
+        if not exists:
+            db.session.execute(
+                f"CREATE VIRTUAL TABLE events_fts USING fts5({SEARCH_COLUMNS}, "
+                "content='events', content_rowid='id')"
+            )
+            db.session.execute("INSERT INTO events_fts (events_fts) VALUES ('rebuild')")
+        for trigger in SEARCH_TRIGGERS:
+            db.session.execute(trigger)
+        db.session.commit()
+        fts_enabled = True
+    except OperationalError as e:
+        db.session.rollback()
+        print(f"Full-text search unavailable, falling back to LIKE: {e}")
+
+
+def match_expression(text):
+    """
+    Turns free text from the client into an FTS5 query that matches every
+    word as a prefix, so partially typed words still find results
+
+    Returns None if the text contains no searchable words
+    """
+    words = re.findall(r"\w+", text)
+    if not words:
+        return None
+    return " ".join(f'"{word}"*' for word in words)
+
+
+def search_event_ids(text, limit, offset=0):
+    """
+    Returns the ids of events matching text, best match first
+    """
+    if fts_enabled:
+        expression = match_expression(text)
+        if expression is None:
+            return []
+        rows = db.session.execute(
+            "SELECT rowid FROM events_fts WHERE events_fts MATCH :expression "
+            "ORDER BY rank LIMIT :limit OFFSET :offset",
+            {"expression": expression, "limit": limit, "offset": offset}
+        )
+        return [row[0] for row in rows]
+    rows = db.session.query(Event.id).filter(Event.title.ilike(f"%{text}%")) \
+        .order_by(Event.date, Event.id).limit(limit).offset(offset)
+    return [row[0] for row in rows]
+
+
+def search_filter(text):
+    """
+    Returns a filter on Event matching text, for combining with other
+    filters in one query
+    """
+    if fts_enabled:
+        expression = match_expression(text)
+        if expression is None:
+            return false()
+        matches = select([literal_column("rowid")]).select_from(table("events_fts")) \
+            .where(literal_column("events_fts").op("MATCH")(expression))
+        return Event.id.in_(matches)
+    return Event.title.ilike(f"%{text}%")
@@ -0,0 +1,185 @@
+# code to fill bukethaca.db with synthetic data
+#
+# generates users, events, categories, buckets, bookmarks and stub assets
+# from a fixed random seed, so two runs with the same arguments produce the
+# same database, e.g. `python seed.py --reset --users 1000 --events 20000`.
+# Stub assets point at images that do not exist; they only give events a
+# ready image to serialize. Rows are written with multi-row inserts so large
+# databases seed in seconds.
+import argparse
+import hashlib
+import os
+import random
+import time
+
+WORDS = [
+    "arts", "quad", "slope", "gorges", "farmers", "market", "concert", "jazz",
+    "hockey", "lynah", "dairy", "bar", "ithaca", "commons", "cascadilla",
+    "library", "uris", "olin", "hackathon", "career", "fair", "dragon", "day",
+    "slope", "day", "movie", "night", "trivia", "karaoke", "robotics", "chess",
+    "poetry", "reading", "yoga", "hike", "taughannock", "falls", "apple",
+    "festival", "cider", "pumpkin", "lecture", "bake", "sale", "showcase",
+]
+HOSTS = ["Cornell Concert Commission", "CU Nooz", "Big Red Hacks", "Slope Media", "Outing Club", "Cornell Cinema"]
+LOCATIONS = ["Bailey Hall", "Willard Straight Hall", "Ho Plaza", "Ithaca Commons", "Duffield Hall", "Lynah Rink"]
+DAY = 24 * 60 * 60
+# rows per multi-row insert; well under SQLite's bound-parameter limit
+INSERT_BATCH = 100
+
+
+def parse_args():
+    """
+    Parses the command line
+    """
+    parser = argparse.ArgumentParser(description="Fill bukethaca.db with synthetic data")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--categories", type=int, default=12)
+    parser.add_argument("--buckets", type=int, default=50)
+    parser.add_argument("--assets", type=int, default=100)
+    parser.add_argument("--bookmarks", type=int, default=20, help="average saved events per user")
+    parser.add_argument("--past", type=float, default=0.1, help="fraction of events already over")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--reset", action="store_true", help="delete the database first")
+    return parser.parse_args()
+
+
+def insert_rows(db, table, rows):
+    """
+    Inserts rows (dicts) into table in batches of INSERT_BATCH
+    """
+    for i in range(0, len(rows), INSERT_BATCH):
+        db.session.execute(table.insert().values(rows[i:i + INSERT_BATCH]))
+
+
+def seed(args, now=None):
+    """
+    Adds the synthetic rows described by args to the database
+
+    Returns the number of rows inserted per table
+    """
+    # imported here so --reset can remove the database before the app
+    # creates it on import
+    from db import db, Asset, Bucket, Category, Event, User
+    from db import ASSET_READY, RECOUNT_CATEGORY_EVENTS
+    from db import category_association_table
+    from db import created_events_association_table
+    from db import saved_buckets_association_table
+    from db import saved_events_association_table
+    from db import user_bucket_list_association_table
+    import recommend
+    import trending
+
+    rng = random.Random(args.seed)
+    now = int(time.time()) if now is None else now
+    tables = {}
+
+    def offset(model):
+        # new rows are numbered after any already in the table
+        return (db.session.query(db.func.max(model.id)).scalar() or 0) + 1
+
+    first = offset(Asset)
+    assets = [{
+        "id": first + i,
+        "base_url": "https://example.com/seed",
+        "salt": hashlib.sha1(f"{args.seed}:{i}".encode()).hexdigest()[:16],
+        "extension": "png",
+        "width": 1280,
+        "height": 720,
+        "status": ASSET_READY,
+        "variants": "thumbnail,card,full",
+        "content_hash": hashlib.sha256(f"seed:{args.seed}:{first + i}".encode()).hexdigest(),
+    } for i in range(max(args.assets, 1))]
+    tables[Asset.__table__] = assets
+
+    first = offset(User)
+    users = [{
+        "id": first + i,
+        "name": f"{rng.choice(WORDS).title()} {rng.choice(WORDS).title()}",
+        "email": f"seed{args.seed}-{first + i}@cornell.edu",
+        "number": rng.randint(2000000000, 9999999999) if rng.random() < 0.5 else None,
+    } for i in range(args.users)]
+    tables[User.__table__] = users
+
+    first = offset(Category)
+    tables[Category.__table__] = [{"id": first + i} for i in range(args.categories)]
+    first = offset(Bucket)
+    tables[Bucket.__table__] = [{"id": first + i} for i in range(args.buckets)]
+
+    first = offset(Event)
+    events = []
+    for i in range(args.events):
+        past = rng.random() < args.past
+        events.append({
+            "id": first + i,
+            "title": " ".join(rng.sample(WORDS, 3)).title(),
+            "host_name": rng.choice(HOSTS),
+            "date": now + (rng.randint(-30 * DAY, -1) if past else rng.randint(60, 120 * DAY)),
+            "location": rng.choice(LOCATIONS),
+            "description": " ".join(rng.choice(WORDS) for _ in range(20)),
+            "image_id": rng.choice(assets)["id"],
+        })
+    tables[Event.__table__] = events
+
+    event_ids = [e["id"] for e in events]
+    user_ids = [u["id"] for u in users]
+    category_ids = [c["id"] for c in tables[Category.__table__]]
+    bucket_ids = [b["id"] for b in tables[Bucket.__table__]]
+    if category_ids:
+        tables[category_association_table] = [
+            {"event_id": event_id, "category_id": category_id}
+            for event_id in event_ids
+            for category_id in rng.sample(category_ids, min(len(category_ids), rng.randint(1, 3)))
+        ]
+    if user_ids:
+        tables[created_events_association_table] = [
+            {"created_events_id": rng.choice(user_ids), "users_created_id": event_id}
+            for event_id in event_ids
+        ]
+
+    def sample(ids, average):
+        return rng.sample(ids, min(len(ids), rng.randint(0, 2 * average)))
+
+    # saved over the last week, so some saves count towards trending
+    tables[saved_events_association_table] = [
+        {"saved_event_id": user_id, "users_saved_id": event_id, "saved_at": now - rng.randint(0, 7 * DAY)}
+        for user_id in user_ids for event_id in sample(event_ids, args.bookmarks)
+    ]
+    tables[saved_buckets_association_table] = [
+        {"saved_bucket_id": user_id, "users_saved_id": bucket_id}
+        for user_id in user_ids for bucket_id in sample(bucket_ids, args.bookmarks // 2)
+    ]
+    tables[user_bucket_list_association_table] = [
+        {"user_bucket_list_id": user_id, "bucket_user_list_id": bucket_id}
+        for user_id in user_ids for bucket_id in sample(bucket_ids, args.bookmarks // 4)
+    ]
+
+    for table, rows in tables.items():
+        insert_rows(db, table, rows)
+    db.session.execute(RECOUNT_CATEGORY_EVENTS)
+    trending.rebuild_counters(now)
+    db.session.commit()
+    trending.refresh_trending(now)
+    recommend.rebuild_similarities()
+    return {table.name: len(rows) for table, rows in tables.items()}
+
+
+def main():
+    """
+    Seeds the database from the command line
+    """
+    args = parse_args()
+    from db import database_path
+    if args.reset and os.path.exists(database_path()):
+        os.remove(database_path())
+    from app import app
+    start = time.monotonic()
+    with app.app_context():
+        counts = seed(args)
+    for table, count in counts.items():
+        print(f"{table}: {count}")
+    print(f"Seeded in {time.monotonic() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Storage backends for uploaded images
+
+Asset hands each backend the decoded bytes of an image and a key; the
+backend stores them and knows the public base URL they are served from.
+Set STORAGE_BACKEND=local to keep images on disk instead of S3, e.g. for
+benchmarks and development without AWS credentials.
+"""
+
+import os
+import shutil
+import threading
+
+import boto3
+
+S3_BUCKET_NAME = os.environ.get("S3_BUCKET_NAME")
+S3_BASE_URL = f"https://{S3_BUCKET_NAME}.s3.us-east-2.amazonaws.com"
+LOCAL_STORAGE_DIR = os.environ.get("LOCAL_STORAGE_DIR", os.path.join(os.getcwd(), "uploads"))
+LOCAL_STORAGE_URL = os.environ.get("LOCAL_STORAGE_URL", "/uploads")
+
+
+class Storage:
+    """
+    Interface every storage backend implements
+    """
+    base_url = None
+
+    def put(self, key, data, content_type=None):
+        """
+        Stores data (bytes) under key
+        """
+        raise NotImplementedError
+
+    def put_file(self, key, fileobj, content_type=None):
+        """
+        Stores the contents of a binary file object under key
+        """
+        self.put(key, fileobj.read(), content_type)
+
+    def url(self, key):
+        """
+        Returns the public URL of key
+        """
+        return f"{self.base_url}/{key}"
+
+
+class S3Storage(Storage):
+    """
+    Stores images as public-read objects in an S3 bucket
+    """
+
+    def __init__(self, bucket=S3_BUCKET_NAME, base_url=S3_BASE_URL):
+        """
+        Initializes a backend for bucket; the client is created on first use
+        """
+        self.bucket = bucket
+        self.base_url = base_url
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        """
+        The shared S3 client, reused for every upload (boto3 clients are
+        thread safe and keep their connection pool between calls)
+        """
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = boto3.client("s3")
+        return self._client
+
+    def put(self, key, data, content_type=None):
+        """
+        Uploads data straight from memory, setting the ACL in the same request
+        """
+        extra = {"ContentType": content_type} if content_type else {}
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=data, ACL="public-read", **extra)
+
+    def put_file(self, key, fileobj, content_type=None):
+        """
+        Uploads a file object in chunks, as a multipart upload when it is large
+        """
+        extra = {"ACL": "public-read"}
+        if content_type:
+            extra["ContentType"] = content_type
+        self.client.upload_fileobj(fileobj, self.bucket, key, ExtraArgs=extra)
+
+
+class LocalStorage(Storage):
+    """
+    Stores images as files in a local directory
+    """
+
+    def __init__(self, root=LOCAL_STORAGE_DIR, base_url=LOCAL_STORAGE_URL):
+        """
+        Initializes a backend writing into root, creating it if needed
+        """
+        self.root = root
+        self.base_url = base_url
+        os.makedirs(root, exist_ok=True)
+
+    def put(self, key, data, content_type=None):
+        """
+        Writes data to root/key
+        """
+        with open(os.path.join(self.root, key), "wb") as f:
+            f.write(data)
+
+    def put_file(self, key, fileobj, content_type=None):
+        """
+        Copies a file object to root/key in chunks
+        """
+        with open(os.path.join(self.root, key), "wb") as f:
+            shutil.copyfileobj(fileobj, f)
+
+
+_storage = None
+
+
+def get_storage():
+    """
+    Returns the process-wide storage backend selected by STORAGE_BACKEND
+    """
+    global _storage
+    if _storage is None:
+        if os.environ.get("STORAGE_BACKEND", "s3") == "local":
+            _storage = LocalStorage()
+        else:
+            _storage = S3Storage()
+    return _storage
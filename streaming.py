@@ -0,0 +1,57 @@
+"""
+Streaming JSON responses
+
+Large lists are encoded item by item as they are read from the database
+instead of being built into one string first, so memory use stays flat no
+matter how many rows a response holds. Rows are read in keyset batches of
+STREAM_BATCH_SIZE, and every batch is sent to the client as one chunk.
+"""
+
+import json
+
+from pagination import paginate_by_date
+
+STREAM_BATCH_SIZE = 100
+
+
+def iter_by_date(query, model, batch_size=STREAM_BATCH_SIZE):
+    """
+    Yields every row of query ordered by (date, id), reading batch_size
+    rows at a time through keyset pagination
+    """
+    cursor = None
+    while True:
+        rows, cursor = paginate_by_date(query, model, cursor, batch_size)
+        yield from rows
+        if cursor is None:
+            break
+
+
+def batched(items, size):
+    """
+    Yields lists of up to size consecutive items
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def stream_json(key, items, serialize, head=None, tail=None, batch_size=STREAM_BATCH_SIZE):
+    """
+    Yields the JSON object {**head, key: [serialize(item) for item in items],
+    **tail} in chunks of batch_size items, formatted as json.dumps would
+    """
+    def members(values):
+        return "".join(f"{json.dumps(k)}: {json.dumps(v)}, " for k, v in values.items())
+
+    yield "{" + members(head or {}) + json.dumps(key) + ": ["
+    separator = ""
+    for batch in batched(items, batch_size):
+        yield separator + ", ".join(json.dumps(serialize(item)) for item in batch)
+        separator = ", "
+    yield "]" + "".join(f", {json.dumps(k)}: {json.dumps(v)}" for k, v in (tail or {}).items()) + "}"
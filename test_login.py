@@ -0,0 +1,277 @@
+"""
+Tests for Google token verification and session tokens
+
+Google's certificate endpoint is stood in for by a local HTTP server, and
+ID tokens are signed with keys generated for the run, so the tests make no
+outbound requests. The app runs against a temporary database.
+
+Run with `python -m unittest test_login`.
+"""
+
+import datetime
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from google.auth import crypt, jwt
+from sqlalchemy import event
+
+_db_dir = tempfile.TemporaryDirectory()
+os.environ["DB_FILENAME"] = os.path.join(_db_dir.name, "test.db")
+os.environ["CLIENT_ID"] = "test-client-id"
+
+import app
+import google_login
+import users_dao
+from db import db
+from db import User
+
+CLIENT_ID = os.environ["CLIENT_ID"]
+
+
+def make_key():
+    """
+    Returns a new RSA private key (PEM) and a self-signed certificate for
+    it (PEM), like the ones Google serves
+    """
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "test")])
+    now = datetime.datetime.utcnow()
+    certificate = x509.CertificateBuilder() \
+        .subject_name(name).issuer_name(name) \
+        .public_key(key.public_key()) \
+        .serial_number(x509.random_serial_number()) \
+        .not_valid_before(now - datetime.timedelta(days=1)) \
+        .not_valid_after(now + datetime.timedelta(days=1)) \
+        .sign(key, hashes.SHA256())
+    private = key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    )
+    return private, certificate.public_bytes(serialization.Encoding.PEM).decode()
+
+
+def make_token(private, key_id, audience=CLIENT_ID, issuer="https://accounts.google.com", email="ezra@cornell.edu"):
+    """
+    Returns an ID token signed with private under key_id
+    """
+    now = int(time.time())
+    payload = {
+        "iss": issuer,
+        "aud": audience,
+        "sub": email,
+        "iat": now,
+        "exp": now + 600,
+        "email": email,
+        "given_name": "Ezra",
+        "family_name": "Cornell",
+    }
+    return jwt.encode(crypt.RSASigner.from_string(private, key_id), payload).decode()
+
+
+class CertServer:
+    """
+    Local stand-in for Google's certificate endpoint, counting its fetches
+    """
+
+    def __init__(self, certs):
+        """
+        Starts serving certs, a dict of key id to PEM certificate
+        """
+        self.certs = certs
+        self.fetches = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.fetches += 1
+                body = json.dumps(server.certs).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Cache-Control", "public, max-age=3600")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = HTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}/certs"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        """
+        Stops serving
+        """
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class CertServerTestCase(unittest.TestCase):
+    """
+    Verifies tokens against a fresh CertServer holding one key, "key-1"
+    """
+
+    def setUp(self):
+        self.private, certificate = make_key()
+        self.server = CertServer({"key-1": certificate})
+        self.addCleanup(self.server.close)
+        certificates = google_login.certificates
+        google_login.certificates = google_login.CertificateCache(self.server.url)
+        self.addCleanup(setattr, google_login, "certificates", certificates)
+
+
+class VerifyTokenTest(CertServerTestCase):
+
+    def test_returns_claims(self):
+        claims = google_login.verify_token(make_token(self.private, "key-1"), CLIENT_ID)
+        self.assertEqual(claims["email"], "ezra@cornell.edu")
+
+    def test_second_verification_makes_no_fetch(self):
+        google_login.verify_token(make_token(self.private, "key-1"), CLIENT_ID)
+        google_login.verify_token(make_token(self.private, "key-1"), CLIENT_ID)
+        self.assertEqual(self.server.fetches, 1)
+
+    def test_unknown_key_id_refetches(self):
+        google_login.verify_token(make_token(self.private, "key-1"), CLIENT_ID)
+        # Google rotates in a new key
+        private, certificate = make_key()
+        self.server.certs["key-2"] = certificate
+        original = google_login.MIN_CERTS_REFRESH
+        google_login.MIN_CERTS_REFRESH = 0
+        self.addCleanup(setattr, google_login, "MIN_CERTS_REFRESH", original)
+
+        claims = google_login.verify_token(make_token(private, "key-2"), CLIENT_ID)
+        self.assertEqual(claims["email"], "ezra@cornell.edu")
+        self.assertEqual(self.server.fetches, 2)
+
+    def test_unknown_key_id_refetches_at_most_every_min_refresh(self):
+        google_login.verify_token(make_token(self.private, "key-1"), CLIENT_ID)
+        private, certificate = make_key()
+        with self.assertRaises(ValueError):
+            google_login.verify_token(make_token(private, "key-2"), CLIENT_ID)
+        with self.assertRaises(ValueError):
+            google_login.verify_token(make_token(private, "key-2"), CLIENT_ID)
+        self.assertEqual(self.server.fetches, 1)
+
+    def test_rejects_wrong_issuer(self):
+        with self.assertRaises(ValueError):
+            google_login.verify_token(make_token(self.private, "key-1", issuer="https://evil.example"), CLIENT_ID)
+
+    def test_rejects_wrong_audience(self):
+        with self.assertRaises(ValueError):
+            google_login.verify_token(make_token(self.private, "key-1", audience="another-client"), CLIENT_ID)
+
+    def test_rejects_wrong_signature(self):
+        private, certificate = make_key()
+        with self.assertRaises(ValueError):
+            google_login.verify_token(make_token(private, "key-1"), CLIENT_ID)
+
+    def test_rejects_malformed_token(self):
+        with self.assertRaises(ValueError):
+            google_login.verify_token("not-a-token", CLIENT_ID)
+
+
+class SessionTest(CertServerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = app.app.test_client()
+        with app.app.app_context():
+            User.query.delete()
+            db.session.commit()
+            engine = db.engine
+        users_dao._sessions.clear()
+        self.statements = []
+        record = lambda conn, cursor, statement, *args: self.statements.append(statement)
+        event.listen(engine, "before_cursor_execute", record)
+        self.addCleanup(event.remove, engine, "before_cursor_execute", record)
+
+    def login(self, token=None):
+        token = make_token(self.private, "key-1") if token is None else token
+        return self.client.post("/api/login/", data=json.dumps({"token": token}))
+
+    def get_me(self, session_token):
+        self.statements.clear()
+        return self.client.get("/api/me/", headers={"Authorization": f"Bearer {session_token}"})
+
+    def test_login_returns_tokens(self):
+        response = self.login()
+        self.assertEqual(response.status_code, 200)
+        body = json.loads(response.data)
+        self.assertEqual(body["email"], "ezra@cornell.edu")
+        for field in ("id", "session_token", "update_token", "session_expiration"):
+            self.assertIn(field, body)
+
+    def test_login_reuses_user(self):
+        first = json.loads(self.login().data)
+        second = json.loads(self.login().data)
+        self.assertEqual(first["id"], second["id"])
+        self.assertNotEqual(first["session_token"], second["session_token"])
+        self.assertEqual(self.get_me(first["session_token"]).status_code, 401)
+
+    def test_invalid_token_is_unauthorized(self):
+        self.assertEqual(self.login("not-a-token").status_code, 401)
+        self.assertEqual(self.login(make_token(self.private, "key-1", audience="another-client")).status_code, 401)
+        self.assertEqual(self.login(make_token(self.private, "key-1", issuer="evil.example")).status_code, 401)
+
+    def test_missing_token(self):
+        self.assertEqual(self.client.post("/api/login/", data="{}").status_code, 400)
+
+    def test_me_uses_session_cache(self):
+        session_token = json.loads(self.login().data)["session_token"]
+        response = self.get_me(session_token)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)["email"], "ezra@cornell.edu")
+        # the login cached nothing yet: the first lookup reads the token
+        lookups = lambda: [s for s in self.statements if "WHERE users.session_token =" in s]
+        self.assertEqual(len(lookups()), 1)
+        self.get_me(session_token)
+        self.assertEqual(lookups(), [])
+
+    def test_me_rejects_bad_tokens(self):
+        self.assertEqual(self.client.get("/api/me/").status_code, 401)
+        self.assertEqual(self.get_me("not-a-session").status_code, 401)
+
+    def test_renew_replaces_session(self):
+        body = json.loads(self.login().data)
+        self.assertEqual(self.get_me(body["session_token"]).status_code, 200)
+        response = self.client.post("/api/session/", headers={"Authorization": f"Bearer {body['update_token']}"})
+        self.assertEqual(response.status_code, 200)
+        renewed = json.loads(response.data)
+        self.assertEqual(renewed["id"], body["id"])
+        # the old session is dropped from the cache, not just the database
+        self.assertEqual(self.get_me(body["session_token"]).status_code, 401)
+        self.assertEqual(self.get_me(renewed["session_token"]).status_code, 200)
+        # update tokens are single use
+        response = self.client.post("/api/session/", headers={"Authorization": f"Bearer {body['update_token']}"})
+        self.assertEqual(response.status_code, 401)
+
+    def test_logout_ends_session(self):
+        body = json.loads(self.login().data)
+        self.assertEqual(self.get_me(body["session_token"]).status_code, 200)
+        response = self.client.post("/api/logout/", headers={"Authorization": f"Bearer {body['session_token']}"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get_me(body["session_token"]).status_code, 401)
+        response = self.client.post("/api/session/", headers={"Authorization": f"Bearer {body['update_token']}"})
+        self.assertEqual(response.status_code, 401)
+        response = self.client.post("/api/logout/", headers={"Authorization": f"Bearer {body['session_token']}"})
+        self.assertEqual(response.status_code, 401)
+
+    def test_delete_user_ends_session(self):
+        body = json.loads(self.login().data)
+        self.assertEqual(self.get_me(body["session_token"]).status_code, 200)
+        self.assertEqual(self.client.get(f"/api/user/{body['id']}/").status_code, 200)
+        self.assertEqual(self.get_me(body["session_token"]).status_code, 401)
+
+
+if __name__ == "__main__":
+    unittest.main()
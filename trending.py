@@ -0,0 +1,142 @@
+"""
+Event popularity counters and the trending ranking
+
+Every save and unsave updates Event.save_count and an hourly counter in
+event_save_buckets with a couple of indexed statements, so neither needs
+the saved rows counted later. refresh_trending scores upcoming events by
+their saves over the last TRENDING_WINDOW_HOURS, each hour weighted down
+by TRENDING_HALF_LIFE_HOURS, and stores the top TRENDING_SIZE in
+trending_events. /api/events/trending/ then reads one keyset page of that
+ranking. The ranking is refreshed by notify.py on every pass, never on a
+request; computed_at in the response tells how old it is.
+"""
+
+import os
+import time
+
+from sqlalchemy import bindparam, text
+
+from db import db
+from db import RECOUNT_EVENT_SAVES
+from db import Event
+from db import EventSaveBucket
+from db import TrendingEvent
+
+HOUR = 60 * 60
+TRENDING_WINDOW_HOURS = int(os.environ.get("TRENDING_WINDOW_HOURS", 72))
+TRENDING_HALF_LIFE_HOURS = float(os.environ.get("TRENDING_HALF_LIFE_HOURS", 24))
+TRENDING_SIZE = int(os.environ.get("TRENDING_SIZE", 500))
+# how long a cached page of the ranking, with its save counts, is served
+TRENDING_TTL = int(os.environ.get("TRENDING_TTL", 5 * 60))
+
+# saved rows of :user_id for :event_ids
+SAVED_ROWS = """
+    FROM association_saved_events
+    WHERE saved_event_id = :user_id AND users_saved_id IN :event_ids
+"""
+
+COUNT_SAVES = [
+    text("UPDATE events SET save_count = save_count + 1 WHERE id IN :event_ids"),
+    text(f"""
+        INSERT INTO event_save_buckets (event_id, hour, count)
+        SELECT users_saved_id, saved_at / {HOUR}, 1 {SAVED_ROWS} AND saved_at IS NOT NULL
+        ON CONFLICT (event_id, hour) DO UPDATE SET count = count + 1
+    """),
+]
+
+UNCOUNT_SAVES = [
+    text(f"UPDATE events SET save_count = save_count - 1 WHERE id IN (SELECT users_saved_id {SAVED_ROWS})"),
+    text(f"""
+        UPDATE event_save_buckets SET count = count - 1
+        WHERE (event_id, hour) IN (SELECT users_saved_id, saved_at / {HOUR} {SAVED_ROWS})
+    """),
+    text("DELETE FROM event_save_buckets WHERE count <= 0 AND event_id IN :event_ids"),
+]
+
+REBUILD_BUCKETS = text(f"""
+    INSERT INTO event_save_buckets (event_id, hour, count)
+    SELECT users_saved_id, saved_at / {HOUR}, count(*) FROM association_saved_events
+    WHERE saved_at >= :since
+    GROUP BY users_saved_id, saved_at / {HOUR}
+""")
+
+
+def _execute(statements, params):
+    """
+    Runs statements taking the expanding :event_ids parameter
+    """
+    for statement in statements:
+        db.session.execute(statement.bindparams(bindparam("event_ids", expanding=True)), params)
+
+
+def record_saves(user_id, event_ids):
+    """
+    Counts user_id saving event_ids; call after the saved rows, with their
+    saved_at, are inserted
+    """
+    if event_ids:
+        _execute(COUNT_SAVES, {"user_id": user_id, "event_ids": list(event_ids)})
+
+
+def forget_saves(user_id, event_ids):
+    """
+    Uncounts user_id saving event_ids; call before the saved rows are
+    deleted
+    """
+    if event_ids:
+        _execute(UNCOUNT_SAVES, {"user_id": user_id, "event_ids": list(event_ids)})
+
+
+def forget_events(event_ids):
+    """
+    Deletes the counters and ranking rows of event_ids, e.g. before
+    deleting them
+    """
+    EventSaveBucket.query.filter(EventSaveBucket.event_id.in_(event_ids)).delete(synchronize_session=False)
+    TrendingEvent.query.filter(TrendingEvent.event_id.in_(event_ids)).delete(synchronize_session=False)
+
+
+def rebuild_counters(now=None):
+    """
+    Recomputes every save_count and the hourly counters of the current
+    window from the saved rows, e.g. after bulk inserts that skipped
+    record_saves; the caller commits
+    """
+    now = int(time.time()) if now is None else now
+    db.session.execute(RECOUNT_EVENT_SAVES)
+    EventSaveBucket.query.delete()
+    since = (now // HOUR - TRENDING_WINDOW_HOURS + 1) * HOUR
+    db.session.execute(REBUILD_BUCKETS, {"since": since})
+
+
+def refresh_trending(now=None):
+    """
+    Recomputes the trending ranking from the hourly counters, dropping
+    counters that have left the window
+
+    Returns the number of events ranked and the time taken
+    """
+    start = time.monotonic()
+    now = int(time.time()) if now is None else now
+    current_hour = now // HOUR
+    first_hour = current_hour - TRENDING_WINDOW_HOURS + 1
+    EventSaveBucket.query.filter(EventSaveBucket.hour < first_hour).delete(synchronize_session=False)
+
+    counters = db.session.query(EventSaveBucket.event_id, EventSaveBucket.hour, EventSaveBucket.count) \
+        .join(Event, Event.id == EventSaveBucket.event_id) \
+        .filter(EventSaveBucket.hour >= first_hour, Event.date >= now)
+    scores = {}
+    for event_id, hour, count in counters:
+        weight = 0.5 ** ((current_hour - hour) / TRENDING_HALF_LIFE_HOURS)
+        scores[event_id] = scores.get(event_id, 0) + count * weight
+    ranking = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:TRENDING_SIZE]
+
+    TrendingEvent.query.delete()
+    if ranking:
+        db.session.execute(TrendingEvent.__table__.insert(), [
+            {"rank": rank, "event_id": event_id, "score": score, "computed_at": now}
+            for rank, (event_id, score) in enumerate(ranking, 1)
+        ])
+    db.session.commit()
+    return {"events": len(ranking), "seconds": round(time.monotonic() - start, 3)}
+
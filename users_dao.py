@@ -2,39 +2,108 @@
 DAO (Data Access Object) file
 
 Helper file containing functions for accessing data in our database
+
+Session lookups go through an in-process TTL cache keyed by token hash, so
+authenticating a request usually needs no query at all. A session ended
+in another process stays usable here for up to SESSION_CACHE_TTL seconds.
 """
 
+import os
+import threading
+import time
+
+from cachetools import TTLCache
+
 from db import User
+from db import hash_token
 
 from db import db
 
+SESSION_CACHE_SIZE = int(os.environ.get("SESSION_CACHE_SIZE", 10000))
+SESSION_CACHE_TTL = int(os.environ.get("SESSION_CACHE_TTL", 60))
+
+# session token hash -> (user id, session expiration)
+_sessions = TTLCache(maxsize=SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL)
+_sessions_lock = threading.Lock()
+
+
+def forget_session(user):
+    """
+    Drops a user's current session from the lookup cache
+    """
+    if user.session_token is not None:
+        with _sessions_lock:
+            _sessions.pop(user.session_token, None)
+
+
+def get_user_id_by_session_token(session_token):
+    """
+    Returns the id of the user with an unexpired session token, or None
+    """
+    key = hash_token(session_token)
+    with _sessions_lock:
+        session = _sessions.get(key)
+    if session is None:
+        session = db.session.query(User.id, User.session_expiration) \
+            .filter(User.session_token == key).first()
+        if session is None:
+            return None
+        with _sessions_lock:
+            _sessions[key] = tuple(session)
+    user_id, expiration = session
+    if expiration is None or expiration < time.time():
+        return None
+    return user_id
+
 
 def get_user_by_session_token(session_token):
     """
     Returns a user object from the database given a session token
     """
-    return User.query.filter(User.session_token == session_token).first()
+    user_id = get_user_id_by_session_token(session_token)
+    if user_id is None:
+        return None
+    return User.query.filter_by(id=user_id).first()
 
 
 def get_user_by_update_token(update_token):
     """
     Returns a user object from the database given an update token
     """
-    return User.query.filter(User.update_token == update_token).first()
+    return User.query.filter(User.update_token == hash_token(update_token)).first()
+
+
+def create_session(user):
+    """
+    Starts a new session for user, ending any current one
+
+    Returns the new tokens; the caller commits
+    """
+    forget_session(user)
+    return user.renew_session()
 
 
 def renew_session(update_token):
     """
     Renews a user's session token
-    
-    Returns the User object
+
+    Returns the User object and the new tokens
     """
     user = get_user_by_update_token(update_token)
 
     if user is None:
-        raise Exception("Invalid update token")
+        raise ValueError("Invalid update token")
 
-    user.renew_session()
+    session = create_session(user)
     db.session.commit()
 
-    return user
+    return user, session
+
+
+def end_session(user):
+    """
+    Logs a user out, invalidating their tokens
+    """
+    forget_session(user)
+    user.end_session()
+    db.session.commit()